@@ -0,0 +1,73 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+
+class Archive(object):
+    """Content addressed store of the raw pages fetched by the scraper.
+
+    Pages are gzip compressed and keyed by the SHA-1 of their url, which is
+    also the "Hash" property of the lecture entities, so that the page of an
+    entry can be found back. Each file holds a JSON line of metadata followed
+    by the page body.
+
+    Writes are atomic, the archive can be shared by threads and processes.
+    """
+
+    def __init__(self, directory):
+        """
+        Args:
+            directory: the archive directory, created if needed.
+        """
+        self._dir = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _Path(self, page_url):
+        digest = hashlib.sha1(page_url.encode("utf-8")).hexdigest()
+        return os.path.join(self._dir, digest[:2], digest + ".gz")
+
+    def Has(self, page_url):
+        return os.path.exists(self._Path(page_url))
+
+    def Put(self, page_url, body):
+        """Archives the body of a page, replacing its previous version."""
+        path = self._Path(page_url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        meta = {"url": page_url, "archived": time.time()}
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as raw, gzip.GzipFile(
+                    fileobj=raw, mode="wb", compresslevel=6) as f:
+                f.write(json.dumps(meta).encode("utf-8") + b"\n")
+                f.write(body)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def Get(self, page_url):
+        """Returns the archived body of a page, None if it is not archived."""
+        try:
+            return Read(self._Path(page_url))[1]
+        except FileNotFoundError:
+            return None
+
+    def Paths(self):
+        """Yields the paths of all the archived pages, to be read with Read."""
+        for prefix in sorted(os.listdir(self._dir)):
+            prefix_dir = os.path.join(self._dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in sorted(os.listdir(prefix_dir)):
+                if name.endswith(".gz"):
+                    yield os.path.join(prefix_dir, name)
+
+
+def Read(path):
+    """Returns the (page url, body) of an archived page file."""
+    with gzip.open(path, "rb") as f:
+        meta = json.loads(f.readline().decode("utf-8"))
+        return meta["url"], f.read()
@@ -0,0 +1,43 @@
+import logging
+import os
+import tempfile
+import unittest
+
+import archive
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._archive = archive.Archive(self._dir.name)
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_put_and_get(self):
+        self.assertFalse(self._archive.Has("http:///page/1"))
+        self.assertIsNone(self._archive.Get("http:///page/1"))
+        self._archive.Put("http:///page/1", "Leçon".encode("utf-8"))
+        self._archive.Put("http:///page/1", "Leçon v2".encode("utf-8"))
+        self.assertTrue(self._archive.Has("http:///page/1"))
+        self.assertEqual(
+            "Leçon v2".encode("utf-8"), self._archive.Get("http:///page/1"))
+
+    def test_keyed_by_sha1_of_url(self):
+        self._archive.Put("http:///page/url", b"body")
+        # hashlib.sha1(b"http:///page/url").hexdigest()
+        self.assertTrue(os.path.exists(os.path.join(
+            self._dir.name, "90",
+            "90314910b3f6a75f8b7e48679a69ed3c251a4463.gz")))
+
+    def test_paths(self):
+        for i in range(5):
+            self._archive.Put("http:///page/%d" % i, b"body %d" % i)
+        self.assertEqual(
+            {("http:///page/%d" % i, b"body %d" % i) for i in range(5)},
+            {archive.Read(path) for path in self._archive.Paths()})
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.DEBUG)
+    unittest.main()
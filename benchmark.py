@@ -0,0 +1,277 @@
+"""Measures the scraper throughput against a local mock of the site.
+
+Serves synthetic listing and lecture pages, generated from the lecture page
+fixture of scraper_test.py, from a local HTTP server and runs Scraper.Run
+against it with an in-memory datastore client. Nothing leaves the machine.
+
+    python benchmark.py --lectures 5000 --concurrency 8
+
+Reports pages/sec, the p50/p99 latency of fetching and parsing a lecture
+page, the peak RSS, the number of datastore RPCs and the latency of each
+stage of the crawl. --min_pages_per_sec makes it exit with an error below a
+given throughput to catch regressions.
+"""
+from http import server
+from urllib import parse
+from urllib import robotparser
+import argparse
+import collections
+import json
+import logging
+import resource
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+from google.cloud import datastore
+
+import fetcher
+import metrics
+import scraper
+import scraper_test
+
+_MONTHS = (
+    "janvier", "février", "mars", "avril", "mai", "juin", "juillet", "août",
+    "septembre", "octobre", "novembre", "décembre")
+
+
+def _LecturePage(i):
+    """Returns a distinct lecture page for each i."""
+    page = scraper_test.LECTURE_PAGE
+    page = page.replace(
+        "Alain Wijffels<span", "Lecturer %d<span" % i, 1)
+    page = page.replace(
+        '<span class="day">29 juin 2017</span>',
+        '<span class="day">%d %s %d</span>' % (
+            i % 28 + 1, _MONTHS[i % 12], 2000 + i % 20))
+    page = page.replace(
+        '<span class="from">17:00</span>',
+        '<span class="from">%02d:00</span>' % (8 + i % 10))
+    page = page.replace(
+        '<span class="to">18:00</span>',
+        '<span class="to">%02d:00</span>' % (9 + i % 10))
+    return page.encode("utf-8")
+
+
+def _ListingPage(offset, page_size, num_lectures):
+    links = "".join(
+        '<li><a href="/site/bench/lecture-%d.htm">Lecture %d</a></li>' % (i, i)
+        for i in range(offset, min(offset + page_size, num_lectures)))
+    last_offset = (num_lectures - 1) // page_size * page_size
+    return (
+        '<html><body><header><a href="/site/college/index.htm">CdF</a>'
+        '</header><p>%d résultats</p><ul>%s</ul>'
+        '<a href="search.jsp?index=%d">Last</a></body></html>' % (
+            num_lectures, links, last_offset)).encode("utf-8")
+
+
+class _Server(socketserver.ThreadingMixIn, server.HTTPServer):
+    daemon_threads = True
+    # Connections beyond the listen backlog are dropped and retried by the
+    # client about a second later, which would be measured instead of the
+    # scraper. Well above any --concurrency benchmarked.
+    request_queue_size = 1024
+
+
+class _Handler(server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # Headers and body are sent separately, do not let Nagle's algorithm
+        # add the client's delayed ACK to every response.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        site = self.server
+        if site.latency_sec:
+            time.sleep(site.latency_sec)
+        url = parse.urlsplit(self.path)
+        if url.path == "/search.jsp":
+            offset = int(parse.parse_qs(url.query).get("index", ["0"])[0])
+            body = _ListingPage(offset, site.page_size, site.num_lectures)
+        elif url.path.startswith("/site/bench/lecture-"):
+            i = int(url.path.rsplit("-", 1)[1].split(".")[0])
+            body = _LecturePage(i)
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _AllowAllRobots(robotparser.RobotFileParser):
+    """Robots rules that allow everything without fetching robots.txt."""
+
+    def read(self):
+        self.parse([])
+
+
+class _FakeDatastoreClient(object):
+    """In-memory datastore client counting its RPCs."""
+
+    def __init__(self):
+        self.entities = {}
+        self.rpcs = collections.Counter()
+        self._lock = threading.Lock()
+
+    def key(self, kind, name):
+        return datastore.Key(kind, name, project="benchmark")
+
+    def get(self, key):
+        found = self.get_multi([key])
+        return found[0] if found else None
+
+    def get_multi(self, keys):
+        with self._lock:
+            self.rpcs["get_multi"] += 1
+            return [self.entities[k] for k in keys if k in self.entities]
+
+    def put(self, entity):
+        self.put_multi([entity])
+
+    def put_multi(self, entities):
+        with self._lock:
+            self.rpcs["put_multi"] += 1
+            for entity in entities:
+                self.entities[entity.key] = entity
+
+
+class _TimedSemaphore(object):
+    """Wraps the semaphore of a page to record when the page got its slot."""
+
+    def __init__(self, semaphore):
+        self._semaphore = semaphore
+        self.start = None
+
+    async def __aenter__(self):
+        await self._semaphore.acquire()
+        self.start = time.perf_counter()
+
+    async def __aexit__(self, *exc_info):
+        self._semaphore.release()
+
+
+def _Percentile(values, percentile):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--lectures", help="Number of lectures on the mock site.", type=int, default=2000)
+    parser.add_argument("--page_size", help="Number of lectures per listing page.", type=int, default=20)
+    parser.add_argument("--latency_ms", help="Latency added to every response of the mock site.", type=float, default=0)
+    parser.add_argument("--concurrency", help="Scraper --concurrency.", type=int, default=1)
+    parser.add_argument("--use_asyncio", help="Scraper --use_asyncio.", action="store_true")
+    parser.add_argument("--listing_concurrency", help="Scraper --listing_concurrency.", type=int, default=4)
+    parser.add_argument("--html_parser", help="Scraper --html_parser.", choices=scraper.HTML_PARSERS, default="html.parser")
+    parser.add_argument("--batch_size", help="Scraper --batch_size.", type=int, default=500)
+    parser.add_argument("--max_rss_mb", help="Scraper --max_rss_mb.", type=float)
+    parser.add_argument("--json", help="Print the report as JSON.", action="store_true")
+    parser.add_argument("--min_pages_per_sec", help="Exit with an error below this throughput.", type=float)
+    args = parser.parse_args()
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.WARNING)
+
+    site = _Server(("127.0.0.1", 0), _Handler)
+    site.num_lectures = args.lectures
+    site.page_size = args.page_size
+    site.latency_sec = args.latency_ms / 1000
+    threading.Thread(
+        target=site.serve_forever, args=(0.01,), daemon=True).start()
+    site_url = "http://127.0.0.1:%d" % site.server_address[1]
+
+    client = _FakeDatastoreClient()
+    crawl_metrics = metrics.Metrics()
+    if args.use_asyncio:
+        page_fetcher = fetcher.AsyncFetcher("benchmark", max_retries=0)
+        scraper_class = scraper.AsyncScraper
+    else:
+        page_fetcher = fetcher.Fetcher("benchmark", max_retries=0)
+        scraper_class = scraper.Scraper
+    s = scraper_class(
+        client,
+        False, # stop_when_present
+        "benchmark",
+        False, # dry_run
+        False, # overwrite
+        _AllowAllRobots(),
+        page_fetcher,
+        concurrency=args.concurrency,
+        batch_size=args.batch_size,
+        html_parser=args.html_parser,
+        listing_concurrency=args.listing_concurrency,
+        site_url=site_url,
+        crawl_metrics=crawl_metrics,
+        max_rss_mb=args.max_rss_mb)
+    latencies = []
+    scrape_page = s._ScrapePage
+
+    def timed_scrape_page(page_url):
+        start = time.perf_counter()
+        try:
+            return scrape_page(page_url)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    s._ScrapePage = timed_scrape_page
+    if args.use_asyncio:
+        scrape_page_async = s._ScrapePageAsync
+
+        async def timed_scrape_page_async(page_url, semaphore):
+            # All the pages of a listing page are started at once, the wait
+            # for a slot is not part of the latency of a page.
+            timed_semaphore = _TimedSemaphore(semaphore)
+            try:
+                return await scrape_page_async(page_url, timed_semaphore)
+            finally:
+                if timed_semaphore.start is not None:
+                    latencies.append(
+                        time.perf_counter() - timed_semaphore.start)
+        s._ScrapePageAsync = timed_scrape_page_async
+
+    start = time.perf_counter()
+    s.Run(site_url + "/search.jsp?type=audio")
+    elapsed = time.perf_counter() - start
+    if not args.use_asyncio:
+        # The async fetcher is closed by the scraper.
+        page_fetcher.Close()
+    site.shutdown()
+
+    report = {
+        "lectures": args.lectures,
+        "pages_scraped": len(latencies),
+        "seconds": round(elapsed, 3),
+        "pages_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(1000 * _Percentile(latencies, 50), 2),
+        "p99_ms": round(1000 * _Percentile(latencies, 99), 2),
+        # ru_maxrss is in kilobytes on Linux.
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "datastore_rpcs": sum(client.rpcs.values()),
+        "datastore_rpcs_by_method": dict(client.rpcs),
+        "status": dict(s._StatusSnapshot()),
+        "stages": crawl_metrics.Summary()["stages"],
+    }
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        for name, value in sorted(report.items()):
+            print("%-25s %s" % (name, value))
+    if args.min_pages_per_sec and report["pages_per_sec"] < args.min_pages_per_sec:
+        print("Throughput below %s pages/sec" % args.min_pages_per_sec)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
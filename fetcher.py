@@ -0,0 +1,564 @@
+from http import client as http_client
+from urllib import error
+from urllib import parse
+import asyncio
+import collections
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import zlib
+
+# A fetched page, body is always decompressed.
+Response = collections.namedtuple(
+    "Response", ["url", "status", "headers", "body"])
+
+# Statuses worth retrying, the server is overloaded or temporarily down.
+RETRIABLE_STATUSES = frozenset([429, 500, 502, 503, 504])
+_REDIRECT_STATUSES = frozenset([301, 302, 303, 307, 308])
+_MAX_REDIRECTS = 5
+
+
+def _decompress(body, encoding):
+    """Decodes a body sent with the given Content-Encoding."""
+    encoding = (encoding or "").strip().lower()
+    if encoding in ("gzip", "x-gzip"):
+        return gzip.decompress(body)
+    if encoding == "deflate":
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            # Some servers send raw deflate streams without the zlib header.
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+
+class _StreamDecompressor(object):
+    """Incrementally decodes a body sent with the given Content-Encoding."""
+
+    def __init__(self, encoding):
+        self._encoding = (encoding or "").strip().lower()
+        self._decompressor = None
+        if self._encoding in ("gzip", "x-gzip"):
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def Decompress(self, chunk):
+        if self._encoding == "deflate" and self._decompressor is None:
+            # Raw deflate streams do not start with the zlib header.
+            self._decompressor = zlib.decompressobj(
+                zlib.MAX_WBITS if chunk[:1] == b"\x78" else -zlib.MAX_WBITS)
+        if self._decompressor is None:
+            return chunk
+        return self._decompressor.decompress(chunk)
+
+    def Flush(self):
+        if self._decompressor is None:
+            return b""
+        return self._decompressor.flush()
+
+
+class _ConnectionPool(object):
+    """Idle keep-alive connections to a single host, shared by threads."""
+
+    def __init__(self, scheme, netloc, timeout, max_idle):
+        self._connection_class = (
+            http_client.HTTPSConnection if scheme == "https"
+            else http_client.HTTPConnection)
+        self._netloc = netloc
+        self._timeout = timeout
+        self._max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def Acquire(self):
+        """Returns a (connection, reused) tuple."""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self.Connect(), False
+
+    def Connect(self):
+        """Returns a new connection, bypassing the idle ones."""
+        return self._connection_class(self._netloc, timeout=self._timeout)
+
+    def Release(self, connection):
+        with self._lock:
+            if len(self._idle) < self._max_idle:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def Close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+class Fetcher(object):
+    """Fetches pages over pooled keep-alive connections.
+
+    Responses are requested compressed and transparently decompressed,
+    transient failures are retried with an exponential backoff. Safe to use
+    from multiple threads.
+    """
+
+    def __init__(
+        self, user_agent, timeout=30, max_retries=3, backoff_sec=1.0,
+        max_idle_per_host=8, retry_statuses=RETRIABLE_STATUSES):
+        """
+        Args:
+            user_agent: user agent string sent with every request.
+            timeout: socket timeout in seconds.
+            max_retries: number of times a failed request is retried.
+            backoff_sec: delay before the first retry, doubled every retry.
+            max_idle_per_host: number of keep-alive connections kept open per
+                host.
+            retry_statuses: statuses retried after the backoff, leave them
+                to the caller to be retried another way, for example after
+                the Retry-After header.
+        """
+        self._user_agent = user_agent
+        self._timeout = timeout
+        self._max_retries = max_retries
+        self._backoff_sec = backoff_sec
+        self._max_idle_per_host = max_idle_per_host
+        self._retry_statuses = frozenset(retry_statuses)
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+
+    def Fetch(self, url, headers=None):
+        """Fetches the given url, following redirects.
+
+        Args:
+            url: absolute http(s) url to fetch.
+            headers: optional dict of extra request headers.
+        Returns:
+            A Response, 304 Not Modified responses are returned as is.
+        Raises:
+            urllib.error.HTTPError: on error statuses once retries are
+                exhausted.
+            OSError: on network errors once retries are exhausted.
+        """
+        return self._Get(url, headers, stream=False)
+
+    def Stream(self, url, headers=None):
+        """Fetches the given url without buffering its body.
+
+        Redirects and retries are handled before the body is returned, a
+        failure while the body is read is not retried. The connection goes
+        back to the pool once the body has been read completely.
+
+        Returns:
+            A Response whose body is an iterator of decompressed chunks of
+            bytes.
+        Raises:
+            Same as Fetch.
+        """
+        return self._Get(url, headers, stream=True)
+
+    def _Get(self, url, headers, stream):
+        for _ in range(_MAX_REDIRECTS + 1):
+            response = self._FetchWithRetries(url, headers, stream)
+            if response.status not in _REDIRECT_STATUSES:
+                break
+            url = parse.urljoin(url, response.headers.get("Location", ""))
+        if response.status >= 400:
+            raise error.HTTPError(
+                url, response.status, http_client.responses.get(
+                    response.status, ""), response.headers, None)
+        return response
+
+    def Close(self):
+        with self._pools_lock:
+            pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            pool.Close()
+
+    def _FetchWithRetries(self, url, headers, stream):
+        delay = self._backoff_sec
+        for attempt in range(self._max_retries + 1):
+            last_attempt = attempt == self._max_retries
+            try:
+                response = self._FetchOnce(url, headers, stream)
+            except (OSError, http_client.HTTPException) as e:
+                if last_attempt:
+                    raise
+                logging.warning("Fetch of %s failed (%s), retrying", url, e)
+            else:
+                if last_attempt or (
+                        response.status not in self._retry_statuses):
+                    return response
+                logging.warning(
+                    "Fetch of %s returned %d, retrying", url, response.status)
+            time.sleep(delay)
+            delay *= 2
+
+    def _FetchOnce(self, url, headers, stream):
+        parts = parse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        request_headers = {
+            "User-Agent": self._user_agent,
+            "Accept-Encoding": "gzip, deflate",
+        }
+        request_headers.update(headers or {})
+        pool = self._Pool(parts.scheme, parts.netloc)
+        connection, reused = pool.Acquire()
+        try:
+            try:
+                connection.request("GET", path, headers=request_headers)
+                resp = connection.getresponse()
+            except (http_client.RemoteDisconnected, ConnectionResetError,
+                    BrokenPipeError):
+                if not reused:
+                    raise
+                # The server closed the idle keep-alive connection, this is
+                # not a failure of the request itself.
+                connection.close()
+                connection = pool.Connect()
+                connection.request("GET", path, headers=request_headers)
+                resp = connection.getresponse()
+            # Only successful bodies are streamed, the others are read right
+            # away so that the request can be retried or redirected.
+            if stream and resp.status < 300:
+                return Response(
+                    url, resp.status, resp.headers,
+                    self._StreamBody(pool, connection, resp))
+            body = resp.read()
+        except Exception:
+            connection.close()
+            raise
+        self._Release(pool, connection, resp)
+        response_headers = resp.headers
+        return Response(
+            url, resp.status, response_headers,
+            _decompress(body, response_headers.get("Content-Encoding")))
+
+    def _StreamBody(self, pool, connection, resp, chunk_size=16 * 1024):
+        decompressor = _StreamDecompressor(
+            resp.headers.get("Content-Encoding"))
+        try:
+            while True:
+                chunk = resp.read(chunk_size)
+                if not chunk:
+                    break
+                chunk = decompressor.Decompress(chunk)
+                if chunk:
+                    yield chunk
+            chunk = decompressor.Flush()
+            if chunk:
+                yield chunk
+        except BaseException:
+            # Also when the body is not read until the end, the connection
+            # cannot be reused then.
+            connection.close()
+            raise
+        self._Release(pool, connection, resp)
+
+    def _Release(self, pool, connection, resp):
+        if resp.will_close:
+            connection.close()
+        else:
+            pool.Release(connection)
+
+    def _Pool(self, scheme, netloc):
+        with self._pools_lock:
+            pool = self._pools.get((scheme, netloc))
+            if pool is None:
+                pool = _ConnectionPool(
+                    scheme, netloc, self._timeout, self._max_idle_per_host)
+                self._pools[(scheme, netloc)] = pool
+            return pool
+
+
+class AsyncFetcher(object):
+    """Fetches pages from an asyncio event loop over pooled keep-alive
+    connections.
+
+    Same as Fetcher, Fetch is a coroutine so that many requests can be in
+    flight from a single thread. Speaks HTTP/1.1 directly over asyncio
+    streams, there is no Stream method. Must only be used from the event
+    loop it was first used in.
+    """
+
+    def __init__(
+        self, user_agent, timeout=30, max_retries=3, backoff_sec=1.0,
+        max_idle_per_host=8, retry_statuses=RETRIABLE_STATUSES):
+        """
+        Args:
+            Same as Fetcher, timeout bounds every attempt of a request.
+        """
+        self._user_agent = user_agent
+        self._timeout = timeout
+        self._max_retries = max_retries
+        self._backoff_sec = backoff_sec
+        self._max_idle_per_host = max_idle_per_host
+        self._retry_statuses = frozenset(retry_statuses)
+        # Idle (reader, writer) stream pairs by (scheme, netloc).
+        self._idle = collections.defaultdict(list)
+
+    async def Fetch(self, url, headers=None):
+        """Same as Fetcher.Fetch."""
+        for _ in range(_MAX_REDIRECTS + 1):
+            response = await self._FetchWithRetries(url, headers)
+            if response.status not in _REDIRECT_STATUSES:
+                break
+            url = parse.urljoin(url, response.headers.get("Location", ""))
+        if response.status >= 400:
+            raise error.HTTPError(
+                url, response.status, http_client.responses.get(
+                    response.status, ""), response.headers, None)
+        return response
+
+    async def Close(self):
+        idle, self._idle = self._idle, collections.defaultdict(list)
+        for connections in idle.values():
+            for _, writer in connections:
+                writer.close()
+
+    async def _FetchWithRetries(self, url, headers):
+        delay = self._backoff_sec
+        for attempt in range(self._max_retries + 1):
+            last_attempt = attempt == self._max_retries
+            try:
+                response = await asyncio.wait_for(
+                    self._FetchOnce(url, headers), self._timeout)
+            except (OSError, EOFError, asyncio.TimeoutError,
+                    http_client.HTTPException) as e:
+                if last_attempt:
+                    raise
+                logging.warning("Fetch of %s failed (%r), retrying", url, e)
+            else:
+                if last_attempt or (
+                        response.status not in self._retry_statuses):
+                    return response
+                logging.warning(
+                    "Fetch of %s returned %d, retrying", url, response.status)
+            await asyncio.sleep(delay)
+            delay *= 2
+
+    async def _FetchOnce(self, url, headers):
+        parts = parse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        request_headers = collections.OrderedDict([
+            ("Host", parts.netloc),
+            ("User-Agent", self._user_agent),
+            ("Accept-Encoding", "gzip, deflate"),
+        ])
+        request_headers.update(headers or {})
+        idle = self._idle[parts.scheme, parts.netloc]
+        reused = bool(idle)
+        reader, writer = idle.pop() if reused else await self._Connect(parts)
+        try:
+            try:
+                status, response_headers, keep_alive = await self._Request(
+                    reader, writer, path, request_headers)
+            except (ConnectionResetError, BrokenPipeError,
+                    asyncio.IncompleteReadError):
+                if not reused:
+                    raise
+                # The server closed the idle keep-alive connection, this is
+                # not a failure of the request itself.
+                writer.close()
+                reader, writer = await self._Connect(parts)
+                status, response_headers, keep_alive = await self._Request(
+                    reader, writer, path, request_headers)
+            body, keep_alive = await self._ReadBody(
+                reader, status, response_headers, keep_alive)
+        except BaseException:
+            # Also when the request timed out, the connection is in an
+            # unknown state.
+            writer.close()
+            raise
+        if keep_alive and len(idle) < self._max_idle_per_host:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+        return Response(
+            url, status, response_headers,
+            _decompress(body, response_headers.get("Content-Encoding")))
+
+    async def _Connect(self, parts):
+        https = parts.scheme == "https"
+        return await asyncio.open_connection(
+            parts.hostname, parts.port or (443 if https else 80),
+            ssl=https or None)
+
+    async def _Request(self, reader, writer, path, headers):
+        """Sends a GET request and reads the status and headers of its answer.
+
+        Returns:
+            A (status, headers, whether the connection can be kept alive)
+            tuple.
+        """
+        lines = ["GET %s HTTP/1.1" % path] + [
+            "%s: %s" % header for header in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            raise http_client.RemoteDisconnected(
+                "Remote end closed connection without response")
+        try:
+            version, status = status_line.split(None, 2)[:2]
+            status = int(status)
+        except ValueError:
+            raise http_client.BadStatusLine(status_line)
+        header_lines = []
+        while True:
+            line = await reader.readline()
+            header_lines.append(line)
+            if line in (b"\r\n", b"\n", b""):
+                break
+        response_headers = http_client.parse_headers(
+            io.BytesIO(b"".join(header_lines)))
+        keep_alive = version == b"HTTP/1.1" and (
+            response_headers.get("Connection", "").lower() != "close")
+        return status, response_headers, keep_alive
+
+    async def _ReadBody(self, reader, status, headers, keep_alive):
+        """Returns the (body, whether the connection can be kept alive)."""
+        if status in (204, 304) or 100 <= status < 200:
+            return b"", keep_alive
+        if "chunked" in headers.get("Transfer-Encoding", "").lower():
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if not size:
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            # Skips the trailers.
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            return b"".join(chunks), keep_alive
+        length = headers.get("Content-Length")
+        if length is not None:
+            return await reader.readexactly(int(length)), keep_alive
+        # The body ends with the connection.
+        return await reader.read(), False
+
+
+class CachingFetcher(object):
+    """Wraps a fetcher with an on-disk HTTP cache using conditional requests.
+
+    Cached pages are revalidated with If-None-Match / If-Modified-Since. A
+    response with status 304 means that the body, served from the cache, is
+    the same as the last time the url was fetched: either the server said so
+    or it sent the exact same bytes again. The least recently used entries
+    are evicted once the cache grows above its maximum size.
+    """
+
+    def __init__(self, page_fetcher, cache_dir, max_bytes):
+        """
+        Args:
+            page_fetcher: the Fetcher doing the actual requests.
+            cache_dir: directory where the cached pages are stored, created
+                if needed.
+            max_bytes: maximum size of the cached bodies on disk.
+        """
+        self._fetcher = page_fetcher
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        # File name to size, least recently used first.
+        self._entries = collections.OrderedDict()
+        self._total_bytes = 0
+        names = [n for n in os.listdir(cache_dir) if not n.startswith(".")]
+        names.sort(key=lambda n: os.stat(os.path.join(cache_dir, n)).st_mtime)
+        for name in names:
+            size = os.path.getsize(os.path.join(cache_dir, name))
+            self._entries[name] = size
+            self._total_bytes += size
+
+    def Fetch(self, url, headers=None):
+        name = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        cached = self._Load(name)
+        request_headers = dict(headers or {})
+        if cached:
+            metadata, _ = cached
+            if metadata.get("etag"):
+                request_headers["If-None-Match"] = metadata["etag"]
+            if metadata.get("last_modified"):
+                request_headers["If-Modified-Since"] = metadata["last_modified"]
+        response = self._fetcher.Fetch(url, request_headers)
+        if response.status == 304 and cached:
+            self._Touch(name)
+            return response._replace(body=cached[1])
+        if response.status != 200:
+            return response
+        body_hash = hashlib.sha1(response.body).hexdigest()
+        if cached and cached[0].get("sha1") == body_hash:
+            self._Touch(name)
+            return response._replace(status=304)
+        self._Store(name, {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "sha1": body_hash,
+        }, response.body)
+        return response
+
+    def Stream(self, url, headers=None):
+        """Same as Fetch, cached bodies are not streamed.
+
+        Returns:
+            A Response whose body is an iterator over a single chunk.
+        """
+        response = self.Fetch(url, headers)
+        return response._replace(body=iter([response.body]))
+
+    def Close(self):
+        self._fetcher.Close()
+
+    def _Load(self, name):
+        """Returns the (metadata, body) cached under name or None."""
+        try:
+            with open(os.path.join(self._cache_dir, name), "rb") as f:
+                metadata = json.loads(f.readline().decode("utf-8"))
+                return metadata, f.read()
+        except (OSError, ValueError):
+            return None
+
+    def _Touch(self, name):
+        with self._lock:
+            if name in self._entries:
+                self._entries.move_to_end(name)
+        try:
+            os.utime(os.path.join(self._cache_dir, name))
+        except OSError:
+            pass
+
+    def _Store(self, name, metadata, body):
+        data = json.dumps(metadata).encode("utf-8") + b"\n" + body
+        if len(data) > self._max_bytes:
+            return
+        # Written to a temporary file first so that readers never see a
+        # partial entry.
+        fd, tmp_path = tempfile.mkstemp(dir=self._cache_dir, prefix=".")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, os.path.join(self._cache_dir, name))
+        evicted = []
+        with self._lock:
+            self._total_bytes += len(data) - self._entries.pop(name, 0)
+            self._entries[name] = len(data)
+            while self._total_bytes > self._max_bytes:
+                evicted_name, size = self._entries.popitem(last=False)
+                self._total_bytes -= size
+                evicted.append(evicted_name)
+        for evicted_name in evicted:
+            try:
+                os.remove(os.path.join(self._cache_dir, evicted_name))
+            except OSError:
+                pass
@@ -0,0 +1,229 @@
+from http import server
+from urllib import error
+import asyncio
+import gzip
+import logging
+import os
+import socketserver
+import tempfile
+import threading
+import unittest
+
+import fetcher
+
+
+class _Server(socketserver.ThreadingMixIn, server.HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append(
+            (self.path, self.client_address, dict(self.headers)))
+        if self.path == "/flaky" and len(self.server.requests) < 3:
+            self._Send(503, b"try again")
+        elif self.path == "/missing":
+            self._Send(404, b"not found")
+        elif self.path == "/etag":
+            if self.headers.get("If-None-Match") == '"v1"':
+                self.send_response(304)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            else:
+                self._Send(200, b"versioned", {"ETag": '"v1"'})
+        elif self.path == "/chunked":
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for chunk in [b"Le", "çon".encode("utf-8"), b""]:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+        elif self.path == "/moved":
+            self.send_response(301)
+            self.send_header("Location", "/page")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            self._Send(200, "Leçon".encode("utf-8"))
+
+    def _Send(self, status, body, headers=None):
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestFetcher(unittest.TestCase):
+    def setUp(self):
+        self._server = _Server(("127.0.0.1", 0), _Handler)
+        self._server.requests = []
+        threading.Thread(
+            target=self._server.serve_forever, args=(0.01,),
+            daemon=True).start()
+        self._root = "http://127.0.0.1:%d" % self._server.server_address[1]
+        self._fetcher = fetcher.Fetcher("Morzina", backoff_sec=0)
+
+    def tearDown(self):
+        self._fetcher.Close()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def test_decompresses_and_reuses_connection(self):
+        first = self._fetcher.Fetch(self._root + "/page?a=b")
+        second = self._fetcher.Fetch(self._root + "/page")
+        self.assertEqual(200, first.status)
+        self.assertEqual("Leçon".encode("utf-8"), first.body)
+        self.assertEqual(first.body, second.body)
+        (path, first_client, headers), (_, second_client, _) = (
+            self._server.requests)
+        self.assertEqual("/page?a=b", path)
+        self.assertEqual("Morzina", headers["User-Agent"])
+        # Both requests went through the same keep-alive connection.
+        self.assertEqual(first_client, second_client)
+
+    def test_stream_decompresses_and_releases_connection(self):
+        response = self._fetcher.Stream(self._root + "/page")
+        self.assertEqual(200, response.status)
+        self.assertEqual("Leçon".encode("utf-8"), b"".join(response.body))
+        self._fetcher.Fetch(self._root + "/page")
+        (_, first_client, _), (_, second_client, _) = self._server.requests
+        self.assertEqual(first_client, second_client)
+
+    def test_retries_server_errors(self):
+        response = self._fetcher.Fetch(self._root + "/flaky")
+        self.assertEqual(200, response.status)
+        self.assertEqual(3, len(self._server.requests))
+
+    def test_leaves_retry_statuses_to_caller(self):
+        self._fetcher = fetcher.Fetcher("Morzina", retry_statuses=())
+        with self.assertRaises(error.HTTPError) as cm:
+            self._fetcher.Fetch(self._root + "/flaky")
+        self.assertEqual(503, cm.exception.code)
+        self.assertEqual(1, len(self._server.requests))
+
+    def test_raises_on_client_errors(self):
+        with self.assertRaises(error.HTTPError) as cm:
+            self._fetcher.Fetch(self._root + "/missing")
+        self.assertEqual(404, cm.exception.code)
+        self.assertEqual(1, len(self._server.requests))
+
+    def test_follows_redirects(self):
+        response = self._fetcher.Fetch(self._root + "/moved")
+        self.assertEqual(self._root + "/page", response.url)
+        self.assertEqual("Leçon".encode("utf-8"), response.body)
+
+
+class TestCachingFetcher(TestFetcher):
+    def setUp(self):
+        super().setUp()
+        self._cache_dir = tempfile.TemporaryDirectory()
+        self._fetcher = fetcher.CachingFetcher(
+            self._fetcher, self._cache_dir.name, max_bytes=1024)
+
+    def tearDown(self):
+        super().tearDown()
+        self._cache_dir.cleanup()
+
+    def test_revalidates_with_etag(self):
+        first = self._fetcher.Fetch(self._root + "/etag")
+        second = self._fetcher.Fetch(self._root + "/etag")
+        self.assertEqual(200, first.status)
+        self.assertEqual(304, second.status)
+        self.assertEqual(b"versioned", second.body)
+        self.assertEqual('"v1"', self._server.requests[1][2]["If-None-Match"])
+
+    def test_same_body_is_not_modified(self):
+        self.assertEqual(200, self._fetcher.Fetch(self._root + "/page").status)
+        second = self._fetcher.Fetch(self._root + "/page")
+        self.assertEqual(304, second.status)
+        self.assertEqual("Leçon".encode("utf-8"), second.body)
+
+    def test_evicts_least_recently_used(self):
+        for i in range(20):
+            self._fetcher.Fetch(self._root + "/page?%d" % i)
+        # The first pages were evicted, the last ones are still cached.
+        self.assertEqual(
+            200, self._fetcher.Fetch(self._root + "/page?0").status)
+        self.assertEqual(
+            304, self._fetcher.Fetch(self._root + "/page?19").status)
+        self.assertLessEqual(
+            sum(os.path.getsize(os.path.join(self._cache_dir.name, n))
+                for n in os.listdir(self._cache_dir.name)),
+            1024)
+
+
+class TestAsyncFetcher(unittest.TestCase):
+    def setUp(self):
+        self._server = _Server(("127.0.0.1", 0), _Handler)
+        self._server.requests = []
+        threading.Thread(
+            target=self._server.serve_forever, args=(0.01,),
+            daemon=True).start()
+        self._root = "http://127.0.0.1:%d" % self._server.server_address[1]
+        self._fetcher = fetcher.AsyncFetcher("Morzina", backoff_sec=0)
+        self._loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self._loop.run_until_complete(self._fetcher.Close())
+        self._loop.close()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _Fetch(self, path):
+        return self._loop.run_until_complete(
+            self._fetcher.Fetch(self._root + path))
+
+    def test_decompresses_and_reuses_connection(self):
+        first = self._Fetch("/page?a=b")
+        second = self._Fetch("/page")
+        self.assertEqual(200, first.status)
+        self.assertEqual("Leçon".encode("utf-8"), first.body)
+        self.assertEqual(first.body, second.body)
+        (path, first_client, headers), (_, second_client, _) = (
+            self._server.requests)
+        self.assertEqual("/page?a=b", path)
+        self.assertEqual("Morzina", headers["User-Agent"])
+        self.assertEqual(first_client, second_client)
+
+    def test_concurrent_fetches(self):
+        async def FetchAll():
+            return await asyncio.gather(*[
+                self._fetcher.Fetch(self._root + "/page?%d" % i)
+                for i in range(10)])
+        responses = self._loop.run_until_complete(FetchAll())
+        self.assertEqual([200] * 10, [r.status for r in responses])
+        self.assertEqual(10, len(self._server.requests))
+
+    def test_reads_chunked_body(self):
+        self.assertEqual("Leçon".encode("utf-8"), self._Fetch("/chunked").body)
+        self._Fetch("/page")
+        (_, first_client, _), (_, second_client, _) = self._server.requests
+        self.assertEqual(first_client, second_client)
+
+    def test_retries_server_errors(self):
+        self.assertEqual(200, self._Fetch("/flaky").status)
+        self.assertEqual(3, len(self._server.requests))
+
+    def test_raises_on_client_errors(self):
+        with self.assertRaises(error.HTTPError) as cm:
+            self._Fetch("/missing")
+        self.assertEqual(404, cm.exception.code)
+
+    def test_follows_redirects(self):
+        response = self._Fetch("/moved")
+        self.assertEqual(self._root + "/page", response.url)
+        self.assertEqual("Leçon".encode("utf-8"), response.body)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.DEBUG)
+    unittest.main()
@@ -0,0 +1,124 @@
+import sqlite3
+import threading
+import time
+
+# Outcomes of pages that should be scraped again when a crawl is resumed.
+RETRY_OUTCOMES = frozenset(["error"])
+
+
+class Frontier(object):
+    """Durable state of a crawl, stored in a SQLite database.
+
+    Records the listing pages that were fully processed, the pages discovered
+    in them and the outcome of each page (the status it was counted as, like
+    "OK", "no_audio", "no_key" or "disallowed") so that a crawl interrupted
+    midway can be resumed instead of started over.
+
+    Changes are only durable once Commit is called. Safe to use from
+    multiple threads.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path: path of the SQLite database, created if needed.
+        """
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS pages (
+                    url TEXT PRIMARY KEY,
+                    listing_offset INTEGER,
+                    outcome TEXT,
+                    updated REAL);
+                CREATE TABLE IF NOT EXISTS listing (
+                    offset INTEGER PRIMARY KEY);
+                CREATE TABLE IF NOT EXISTS crawl (
+                    key TEXT PRIMARY KEY,
+                    value TEXT);
+            """)
+            self._db.commit()
+
+    def IsFinished(self):
+        """Whether the last crawl recorded in the frontier ran until the end."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM crawl WHERE key = 'finished'").fetchone()
+        return bool(row and row[0] == "1")
+
+    def Reset(self):
+        """Forgets everything to start a new crawl."""
+        with self._lock:
+            self._db.execute("DELETE FROM pages")
+            self._db.execute("DELETE FROM listing")
+            self._db.execute("DELETE FROM crawl")
+            self._db.commit()
+
+    def MarkFinished(self):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO crawl VALUES ('finished', '1')")
+            self._db.commit()
+
+    def Discover(self, urls, listing_offset):
+        """Records pages found on the listing page at the given offset."""
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO pages (url, listing_offset) "
+                "VALUES (?, ?)",
+                [(url, listing_offset) for url in urls])
+
+    def Record(self, url, outcome):
+        """Records the outcome of scraping a page."""
+        with self._lock:
+            self._db.execute(
+                "INSERT OR IGNORE INTO pages (url) VALUES (?)", (url,))
+            self._db.execute(
+                "UPDATE pages SET outcome = ?, updated = ? WHERE url = ?",
+                (outcome, time.time(), url))
+
+    def DonePages(self, urls):
+        """Returns the subset of urls that have a final outcome."""
+        urls = list(urls)
+        if not urls:
+            return set()
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT url, outcome FROM pages WHERE url IN (%s)" %
+                ",".join("?" * len(urls)), urls).fetchall()
+        return {
+            url for url, outcome in rows
+            if outcome is not None and outcome not in RETRY_OUTCOMES}
+
+    def PendingPages(self):
+        """Returns the pages discovered but not scraped, or that failed."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT url, outcome FROM pages ORDER BY listing_offset, url"
+            ).fetchall()
+        return [
+            url for url, outcome in rows
+            if outcome is None or outcome in RETRY_OUTCOMES]
+
+    def ListingDone(self, listing_offset):
+        """Records that all the pages of a listing page were processed."""
+        with self._lock:
+            self._db.execute(
+                "INSERT OR IGNORE INTO listing VALUES (?)", (listing_offset,))
+
+    def LastListingOffset(self):
+        """Returns the offset of the last processed listing page or None."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT MAX(offset) FROM listing").fetchone()[0]
+
+    def Commit(self):
+        with self._lock:
+            self._db.commit()
+
+    def Close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
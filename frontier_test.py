@@ -0,0 +1,50 @@
+import logging
+import os
+import tempfile
+import unittest
+
+import frontier
+
+
+class TestFrontier(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._path = os.path.join(self._dir.name, "frontier.db")
+        self._frontier = frontier.Frontier(self._path)
+
+    def tearDown(self):
+        self._frontier.Close()
+        self._dir.cleanup()
+
+    def test_outcomes_survive_reopening_once_committed(self):
+        self._frontier.Discover(["http:///1", "http:///2", "http:///3"], 0)
+        self._frontier.Record("http:///1", "OK")
+        self._frontier.Record("http:///2", "error")
+        self._frontier.ListingDone(0)
+        self._frontier.Commit()
+        # Not committed, as if the crawl was interrupted here.
+        self._frontier.Record("http:///3", "no_audio")
+
+        resumed = frontier.Frontier(self._path)
+        self.addCleanup(resumed.Close)
+        self.assertEqual(
+            {"http:///1"},
+            resumed.DonePages(["http:///1", "http:///2", "http:///3"]))
+        self.assertEqual(["http:///2", "http:///3"], resumed.PendingPages())
+        self.assertEqual(0, resumed.LastListingOffset())
+        self.assertFalse(resumed.IsFinished())
+
+    def test_reset(self):
+        self._frontier.Record("http:///1", "OK")
+        self._frontier.ListingDone(10)
+        self._frontier.MarkFinished()
+        self.assertTrue(self._frontier.IsFinished())
+        self._frontier.Reset()
+        self.assertFalse(self._frontier.IsFinished())
+        self.assertEqual(set(), self._frontier.DonePages(["http:///1"]))
+        self.assertIsNone(self._frontier.LastListingOffset())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.DEBUG)
+    unittest.main()
@@ -0,0 +1,236 @@
+"""Latency histograms and counters of the stages of a crawl.
+
+Stages like fetch, parse or datastore_put are timed with Metrics.Time and
+events are counted with Metrics.Increment. The result can be served in the
+Prometheus text format while the crawl runs or summarized as JSON once it is
+over.
+"""
+from http import server
+import bisect
+import collections
+import contextlib
+import socketserver
+import threading
+import time
+
+# Upper bounds in seconds of the latency histogram buckets.
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+    30)
+
+
+class Histogram(object):
+    """Distribution of latencies in fixed buckets, safe to use from multiple
+    threads."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._buckets = tuple(buckets)
+        # The last bucket holds the values above the highest bound.
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def Observe(self, seconds):
+        i = bisect.bisect_left(self._buckets, seconds)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += seconds
+            self._count += 1
+
+    def Merge(self, other):
+        """Adds the observations of another histogram with the same buckets."""
+        buckets, counts, total, count = other.Snapshot()
+        if buckets != self._buckets:
+            raise ValueError("Cannot merge histograms with different buckets")
+        with self._lock:
+            self._counts = [a + b for a, b in zip(self._counts, counts)]
+            self._sum += total
+            self._count += count
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def Snapshot(self):
+        """Returns a (buckets, counts per bucket, sum, count) tuple."""
+        with self._lock:
+            return self._buckets, list(self._counts), self._sum, self._count
+
+    def Quantile(self, q):
+        """Returns the upper bound of the bucket holding the q quantile.
+
+        Values above the highest bucket are reported as the highest bound.
+        """
+        buckets, counts, _, count = self.Snapshot()
+        if not count:
+            return 0
+        rank = q * count
+        seen = 0
+        for bound, bucket_count in zip(buckets, counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return buckets[-1]
+
+
+class Metrics(object):
+    """Per stage latency histograms and labelled counters of a crawl.
+
+    Can be pickled, for example to be returned by a worker process and merged
+    with the metrics of the other workers.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._buckets = buckets
+        self._histograms = collections.OrderedDict()
+        self._counters = collections.Counter()
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+
+    def _Histogram(self, stage):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram(self._buckets)
+            return histogram
+
+    def Observe(self, stage, seconds):
+        """Records that the given stage took that many seconds."""
+        self._Histogram(stage).Observe(seconds)
+
+    @contextlib.contextmanager
+    def Time(self, stage):
+        """Context manager recording how long its block took, even if it
+        raised."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.Observe(stage, time.perf_counter() - start)
+
+    def Increment(self, name, value=1, **labels):
+        """Adds value to the counter with the given name and labels."""
+        with self._lock:
+            self._counters[name, tuple(sorted(labels.items()))] += value
+
+    def Merge(self, other):
+        """Adds the observations and counters of other to these metrics.
+
+        The time elapsed is counted from the earliest of the two.
+        """
+        with other._lock:
+            histograms = list(other._histograms.items())
+            counters = collections.Counter(other._counters)
+            start = other._start
+        for stage, histogram in histograms:
+            self._Histogram(stage).Merge(histogram)
+        with self._lock:
+            self._counters.update(counters)
+            self._start = min(self._start, start)
+
+    __getstate__ = Histogram.__getstate__
+    __setstate__ = Histogram.__setstate__
+
+    def Summary(self):
+        """Returns the metrics as a dict that can be serialized to JSON.
+
+        Throughputs are computed over the time elapsed since the metrics
+        were created.
+        """
+        elapsed = time.monotonic() - self._start
+        with self._lock:
+            histograms = list(self._histograms.items())
+            counters = sorted(self._counters.items())
+        stages = collections.OrderedDict()
+        for stage, histogram in histograms:
+            _, _, total, count = histogram.Snapshot()
+            stages[stage] = {
+                "count": count,
+                "total_sec": round(total, 3),
+                "mean_ms": round(1000 * total / count, 2) if count else 0,
+                "p50_ms": round(1000 * histogram.Quantile(0.5), 2),
+                "p99_ms": round(1000 * histogram.Quantile(0.99), 2),
+                "per_sec": round(count / elapsed, 2) if elapsed else 0,
+            }
+        return {
+            "elapsed_sec": round(elapsed, 3),
+            "stages": stages,
+            "counters": collections.OrderedDict(
+                (_SeriesName(name, labels), value)
+                for (name, labels), value in counters),
+        }
+
+    def PrometheusText(self, prefix="scraper"):
+        """Returns the metrics in the Prometheus text exposition format."""
+        with self._lock:
+            histograms = list(self._histograms.items())
+            counters = sorted(self._counters.items())
+        lines = []
+        name = prefix + "_stage_latency_seconds"
+        if histograms:
+            lines.append("# TYPE %s histogram" % name)
+        for stage, histogram in histograms:
+            buckets, counts, total, count = histogram.Snapshot()
+            labels = (("stage", stage),)
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append("%s %d" % (_SeriesName(
+                    name + "_bucket", labels + (("le", repr(bound)),)),
+                    cumulative))
+            lines.append("%s %d" % (
+                _SeriesName(name + "_bucket", labels + (("le", "+Inf"),)),
+                count))
+            lines.append("%s %r" % (_SeriesName(name + "_sum", labels), total))
+            lines.append("%s %d" % (_SeriesName(name + "_count", labels), count))
+        typed = set()
+        for (counter, labels), value in counters:
+            counter = "%s_%s_total" % (prefix, counter)
+            if counter not in typed:
+                lines.append("# TYPE %s counter" % counter)
+                typed.add(counter)
+            lines.append("%s %d" % (_SeriesName(counter, labels), value))
+        return "\n".join(lines) + "\n"
+
+    def Serve(self, port, host=""):
+        """Serves PrometheusText over HTTP from a background thread.
+
+        Returns:
+            The HTTP server, call its shutdown method to stop serving.
+        """
+        metrics = self
+
+        class Handler(server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.PrometheusText().encode("utf-8")
+                self.send_response(200)
+                self.send_header(
+                    "Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        httpd = _Server((host, port), Handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        return httpd
+
+
+class _Server(socketserver.ThreadingMixIn, server.HTTPServer):
+    daemon_threads = True
+
+
+def _SeriesName(name, labels):
+    if not labels:
+        return name
+    return "%s{%s}" % (name, ",".join(
+        '%s="%s"' % (label, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for label, value in labels))
@@ -0,0 +1,98 @@
+from urllib import request
+import logging
+import pickle
+import unittest
+
+import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self._metrics = metrics.Metrics(buckets=(0.01, 0.1, 1))
+
+    def test_histogram_quantiles(self):
+        histogram = metrics.Histogram(buckets=(0.01, 0.1, 1))
+        for seconds in [0.005] * 90 + [0.05] * 9 + [5]:
+            histogram.Observe(seconds)
+        self.assertEqual(0.01, histogram.Quantile(0.5))
+        self.assertEqual(0.1, histogram.Quantile(0.99))
+        # Values above the highest bucket are capped to it.
+        self.assertEqual(1, histogram.Quantile(1))
+        self.assertEqual(0, metrics.Histogram().Quantile(0.5))
+
+    def test_time_records_even_on_errors(self):
+        with self.assertRaises(ValueError):
+            with self._metrics.Time("parse"):
+                raise ValueError()
+        with self._metrics.Time("parse"):
+            pass
+        self.assertEqual(2, self._metrics.Summary()["stages"]["parse"]["count"])
+
+    def test_summary(self):
+        self._metrics.Observe("fetch", 0.05)
+        self._metrics.Observe("fetch", 0.5)
+        self._metrics.Increment("pages", status="OK")
+        self._metrics.Increment("pages", 2, status="OK")
+        self._metrics.Increment("entities_written", 3)
+        summary = self._metrics.Summary()
+        fetch = summary["stages"]["fetch"]
+        self.assertEqual(2, fetch["count"])
+        self.assertEqual(0.55, fetch["total_sec"])
+        self.assertEqual(275, fetch["mean_ms"])
+        self.assertEqual(100, fetch["p50_ms"])
+        self.assertEqual(1000, fetch["p99_ms"])
+        self.assertEqual(
+            {"entities_written": 3, 'pages{status="OK"}': 3},
+            dict(summary["counters"]))
+
+    def test_prometheus_text(self):
+        self._metrics.Observe("fetch", 0.05)
+        self._metrics.Observe("fetch", 5)
+        self._metrics.Increment("pages", status="OK")
+        self._metrics.Increment("pages", status="no_audio")
+        self.assertEqual(
+            "# TYPE scraper_stage_latency_seconds histogram\n"
+            'scraper_stage_latency_seconds_bucket{stage="fetch",le="0.01"} 0\n'
+            'scraper_stage_latency_seconds_bucket{stage="fetch",le="0.1"} 1\n'
+            'scraper_stage_latency_seconds_bucket{stage="fetch",le="1"} 1\n'
+            'scraper_stage_latency_seconds_bucket{stage="fetch",le="+Inf"} 2\n'
+            'scraper_stage_latency_seconds_sum{stage="fetch"} 5.05\n'
+            'scraper_stage_latency_seconds_count{stage="fetch"} 2\n'
+            "# TYPE scraper_pages_total counter\n"
+            'scraper_pages_total{status="OK"} 1\n'
+            'scraper_pages_total{status="no_audio"} 1\n',
+            self._metrics.PrometheusText())
+
+    def test_merge_pickled_metrics(self):
+        other = metrics.Metrics(buckets=(0.01, 0.1, 1))
+        other.Observe("fetch", 0.05)
+        other.Increment("pages", status="OK")
+        self._metrics.Observe("fetch", 0.5)
+        self._metrics.Observe("parse", 0.005)
+        self._metrics.Increment("pages", status="OK")
+        self._metrics.Merge(pickle.loads(pickle.dumps(other)))
+        summary = self._metrics.Summary()
+        self.assertEqual(2, summary["stages"]["fetch"]["count"])
+        self.assertEqual(0.55, summary["stages"]["fetch"]["total_sec"])
+        self.assertEqual(1, summary["stages"]["parse"]["count"])
+        self.assertEqual(
+            {'pages{status="OK"}': 2}, dict(summary["counters"]))
+        other = metrics.Metrics(buckets=(1, 2))
+        other.Observe("fetch", 0.05)
+        with self.assertRaises(ValueError):
+            self._metrics.Merge(other)
+
+    def test_serve(self):
+        self._metrics.Increment("pages", status="OK")
+        httpd = self._metrics.Serve(0, host="127.0.0.1")
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(httpd.shutdown)
+        with request.urlopen(
+                "http://127.0.0.1:%d/metrics" % httpd.server_address[1]) as resp:
+            self.assertEqual(
+                self._metrics.PrometheusText(), resp.read().decode("utf-8"))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.DEBUG)
+    unittest.main()
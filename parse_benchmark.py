@@ -0,0 +1,95 @@
+"""Compares the lecture extraction with the BeautifulSoup tree it replaced.
+
+Checks that every parser backend extracts exactly the same fields as the
+original BeautifulSoup code on the lecture page fixture of scraper_test.py,
+then reports how long each one takes per page.
+
+    python parse_benchmark.py --iterations 500
+"""
+import argparse
+import sys
+import timeit
+
+from bs4 import BeautifulSoup
+
+import scraper
+import scraper_test
+
+
+def _trimmed_text(node):
+    try:
+        return node.text.strip()
+    except AttributeError:
+        return None
+
+
+def _first_link(node):
+    try:
+        return node.find("a").get("href")
+    except AttributeError:
+        return None
+
+
+def _ExtractLectureWithSoup(body):
+    """The fields as found by the original full BeautifulSoup tree."""
+    s = BeautifulSoup(body, "html.parser")
+    fields = {
+        "audio_link": _first_link(s.find("li", "audio")),
+        "video_link": _first_link(s.find("li", "video")),
+        "day": _trimmed_text(s.find("span", "day")),
+        "from": _trimmed_text(s.find("span", "from")),
+        "to": _trimmed_text(s.find("span", "to")),
+        "type": _trimmed_text(s.find("span", "type")),
+        "title": _trimmed_text(s.find(id="title")),
+        "type_title": _trimmed_text(s.find("h4")),
+        "chair": _trimmed_text(s.find("div", "chair-baseline")),
+    }
+    lecturer = s.find("h3", "lecturer")
+    if lecturer:
+        children = list(lecturer.children)
+        fields["lecturer"] = str(children[0]).strip() if children else None
+        fields["function"] = (
+            children[1].text.strip() if len(children) > 1 else None)
+    return fields
+
+
+def _Comparable(fields):
+    """Missing and None fields are equivalent."""
+    return {k: v for k, v in fields.items() if v is not None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--iterations", help="Number of times each page is parsed.",
+        type=int, default=200)
+    args = parser.parse_args()
+
+    body = scraper_test.LECTURE_PAGE.encode("utf-8")
+    expected = _Comparable(_ExtractLectureWithSoup(body))
+    extractors = [("BeautifulSoup tree", _ExtractLectureWithSoup)]
+    for html_parser in scraper.HTML_PARSERS:
+        if html_parser == "lxml" and scraper.etree is None:
+            print("lxml is not installed, skipping it")
+            continue
+        extractors.append((
+            "single pass " + html_parser,
+            lambda b, p=html_parser: scraper._ExtractLecture(b, p)))
+
+    parity = True
+    for name, extract in extractors:
+        fields = _Comparable(extract(body))
+        if fields != expected:
+            parity = False
+            print("%s differs: %s != %s" % (name, fields, expected))
+        seconds = timeit.timeit(
+            lambda: extract(body), number=args.iterations)
+        print("%-30s %8.3f ms/page" % (
+            name, 1000 * seconds / args.iterations))
+    if not parity:
+        sys.exit(1)
+    print("All extractors agree on the fixture.")
+
+
+if __name__ == "__main__":
+    main()
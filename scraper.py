@@ -1,33 +1,755 @@
-from urllib import request
+from concurrent import futures
+from html import parser as html_parser
+from urllib import error
+from urllib import parse
 from urllib import robotparser
 import argparse
+import asyncio
+import codecs
+import contextlib
+import cProfile
+import itertools
+import re
+import threading
 import time
 import datetime
-import locale
+import functools
+import gc
 import hashlib
+import json
 import logging
 import collections
+import os
+import resource
 
-from bs4 import BeautifulSoup
+from bs4 import UnicodeDammit
 from google.cloud import datastore
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
 
-def _trimmed_text(node):
-    """Returns the trimmed text contained in the given DOM node or None if
-    empty or if node is None.
+import archive
+import fetcher
+import frontier
+import metrics
+import sinks
+
+# Parsers that can be used to extract lectures.
+HTML_PARSERS = ("html.parser", "lxml")
+
+# Fields holding the text of the first element with the given tag and class.
+_TEXT_FIELDS = {
+    ("span", "day"): "day",
+    ("span", "from"): "from",
+    ("span", "to"): "to",
+    ("span", "type"): "type",
+    ("div", "chair-baseline"): "chair",
+}
+# Fields holding the href of the first link in the first <li> with the class.
+_LINK_FIELDS = {
+    "audio": "audio_link",
+    "video": "video_link",
+}
+
+
+class _Capture(object):
+    """An element whose text is being collected."""
+    __slots__ = ("field", "tag", "level", "depth", "parts", "children")
+
+    def __init__(self, field, tag, level):
+        self.field = field
+        self.tag = tag
+        # Nesting level of the element in the document.
+        self.level = level
+        # Number of open elements with the same tag, the capture ends when the
+        # element it started on is closed.
+        self.depth = 1
+        self.parts = []
+        # Number of child elements started so far.
+        self.children = 0
+
+
+class _LectureExtractor(object):
+    """Extracts the fields of a lecture page in a single pass.
+
+    This is a parser target, it receives start/end/data events from lxml or
+    from _StdlibParser and only keeps the text of the few elements that make
+    up a lecture, no tree is ever built. Like BeautifulSoup's find, only the
+    first element matching each field is used.
+    """
+
+    def __init__(self):
+        self.fields = {}
+        self._captures = []
+        # Field and depth of the <li> waiting for its first link.
+        self._link = None
+        self._level = 0
+
+    def start(self, tag, attrs):
+        starts_function = False
+        for capture in self._captures:
+            if capture.level == self._level:
+                capture.children += 1
+                # The function of the lecturer is the element after the name.
+                starts_function |= (
+                    capture.field == "lecturer" and
+                    capture.children == (1 if capture.parts else 2))
+            if capture.tag == tag:
+                capture.depth += 1
+        self._level += 1
+        if starts_function:
+            self._Capture("function", tag)
+        if self._link:
+            field, depth = self._link
+            if tag == "li":
+                self._link = (field, depth + 1)
+            elif tag == "a":
+                self.fields[field] = attrs.get("href")
+                self._link = None
+        classes = (attrs.get("class") or "").split()
+        for cls in classes:
+            field = _TEXT_FIELDS.get((tag, cls))
+            if field:
+                self._Capture(field, tag)
+            elif tag == "li" and cls in _LINK_FIELDS:
+                field = _LINK_FIELDS[cls]
+                if field not in self.fields and not self._link:
+                    self.fields[field] = None
+                    self._link = (field, 1)
+            elif tag == "h3" and cls == "lecturer":
+                self._Capture("lecturer", tag)
+        if tag == "h4":
+            self._Capture("type_title", tag)
+        if attrs.get("id") == "title":
+            self._Capture("title", tag)
+
+    def end(self, tag):
+        self._level = max(0, self._level - 1)
+        if self._link and tag == "li":
+            field, depth = self._link
+            self._link = (field, depth - 1) if depth > 1 else None
+        for capture in list(self._captures):
+            if capture.tag != tag:
+                continue
+            capture.depth -= 1
+            if capture.depth == 0:
+                self._captures.remove(capture)
+                self.fields[capture.field] = "".join(capture.parts).strip()
+
+    def data(self, data):
+        for capture in self._captures:
+            # Only the text before the first child is the lecturer's name.
+            if capture.field != "lecturer" or not capture.children:
+                capture.parts.append(data)
+
+    def close(self):
+        # Unclosed elements at the end of the document.
+        for capture in self._captures:
+            self.fields[capture.field] = "".join(capture.parts).strip()
+        self._captures = []
+        if self.fields.get("lecturer") == "":
+            # An empty heading has no name.
+            self.fields["lecturer"] = None
+        return self.fields
+
+    def _Capture(self, field, tag):
+        if field in self.fields:
+            return
+        self.fields[field] = None
+        self._captures.append(_Capture(field, tag, self._level))
+
+
+class _StdlibParser(html_parser.HTMLParser):
+    """Feeds the events of the standard library HTML parser to a target."""
+
+    # Elements that never have an end tag.
+    _VOID_ELEMENTS = frozenset([
+        "area", "base", "br", "col", "embed", "hr", "img", "input", "link",
+        "meta", "param", "source", "track", "wbr"])
+
+    def __init__(self, target):
+        super().__init__()
+        self._target = target
+
+    def handle_starttag(self, tag, attrs):
+        self._target.start(tag, dict(attrs))
+        if tag in self._VOID_ELEMENTS:
+            self._target.end(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self._target.start(tag, dict(attrs))
+        self._target.end(tag)
+
+    def handle_endtag(self, tag):
+        if tag not in self._VOID_ELEMENTS:
+            self._target.end(tag)
+
+    def handle_data(self, data):
+        self._target.data(data)
+
+    def close(self):
+        super().close()
+        return self._target.close()
+
+
+def _ExtractLecture(body, parser="html.parser"):
+    """Extracts the raw fields of a lecture page.
+
+    Args:
+        body: the page content, bytes or str.
+        parser: one of HTML_PARSERS.
+    Returns:
+        A dict with the stripped text of the "lecturer", "function", "day",
+        "from", "to", "type", "title", "type_title" and "chair" fields and the
+        "audio_link" and "video_link" hrefs, a field is absent or None if not
+        found in the page.
+    """
+    if isinstance(body, bytes):
+        body = UnicodeDammit(body).unicode_markup or ""
+    target = _LectureExtractor()
+    if parser == "lxml":
+        if etree is None:
+            raise ValueError("lxml is not installed")
+        html = etree.HTMLParser(target=target)
+        html.feed(body)
+        return html.close()
+    html = _StdlibParser(target)
+    html.feed(body)
+    return html.close()
+
+
+def _ExtractArchivedLecture(path, parser="html.parser"):
+    """Extracts the raw fields of a lecture page from the archive.
+
+    Meant to run in a worker process, see Scraper.Reparse.
+
+    Returns:
+        A (page url, fields, seconds spent parsing) tuple, fields are as
+        returned by _ExtractLecture. Fields are None if the page could not be
+        read or parsed, the page url is the path if it could not be read.
+    """
+    page_url = path
+    start = time.perf_counter()
+    try:
+        page_url, body = archive.Read(path)
+        start = time.perf_counter()
+        fields = _ExtractLecture(body, parser)
+    except Exception:
+        logging.exception("Failed to extract the lecture of %s", page_url)
+        fields = None
+    return page_url, fields, time.perf_counter() - start
+
+
+def _ExtractArchivedLectures(paths, parser="html.parser"):
+    """Same as _ExtractArchivedLecture for a list of paths, returns a list."""
+    return [_ExtractArchivedLecture(path, parser) for path in paths]
+
+
+# Total number of results as displayed on listing pages.
+_RESULTS_COUNT_RE = re.compile(r"(\d[\d\s.]*)\s*r[ée]sultats?\b", re.IGNORECASE)
+
+
+class _ListingLinkExtractor(html_parser.HTMLParser):
+    """Collects the links to lectures of a listing page as it is fed.
+
+    Links in the header, navigation menus and footer are not results. The
+    pagination links and the results count are recorded to know the page
+    size and how many listing pages there are.
+    """
+
+    _NAVIGATION_TAGS = frozenset(["header", "nav", "footer"])
+
+    def __init__(self):
+        super().__init__()
+        self._links = []
+        self._page_links = set()
+        self._navigation_depth = 0
+        # "index" parameters of the pagination links.
+        self._indexes = set()
+        # Largest "index" parameter of the pagination links.
+        self.max_index = None
+        self.results_count = None
+
+    @property
+    def num_links(self):
+        """Number of distinct result links on the page."""
+        return len(self._page_links)
+
+    def PageSize(self, offset):
+        """Returns the number of results per listing page.
+
+        It is the smallest step between the offset of the page and the
+        indexes of its pagination links, a result can link to several pages.
+        The links are only counted when there is no pagination, or when it
+        only links to far pages such as the last one.
+
+        Args:
+            offset: offset of the parsed listing page.
+        """
+        indexes = sorted(self._indexes | {offset})
+        steps = [b - a for a, b in zip(indexes, indexes[1:])]
+        return min(steps + [self.num_links])
+
+    def LastOffset(self, page_size):
+        """Returns the offset of the last listing page, None if unknown."""
+        offsets = []
+        if self.max_index is not None:
+            offsets.append(self.max_index)
+        if self.results_count:
+            offsets.append((self.results_count - 1) // page_size * page_size)
+        return max(offsets) if offsets else None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self._NAVIGATION_TAGS:
+            self._navigation_depth += 1
+        if tag != "a":
+            return
+        href = dict(attrs).get("href")
+        if not href:
+            return
+        for index in parse.parse_qs(parse.urlsplit(href).query).get(
+                "index", []):
+            if index.isdigit():
+                self._indexes.add(int(index))
+                self.max_index = max(self.max_index or 0, int(index))
+        if href.startswith("/site/") and not self._navigation_depth:
+            if href not in self._page_links:
+                self._page_links.add(href)
+                self._links.append(href)
+
+    def handle_endtag(self, tag):
+        if tag in self._NAVIGATION_TAGS and self._navigation_depth:
+            self._navigation_depth -= 1
+
+    def handle_data(self, data):
+        if self.results_count is None:
+            match = _RESULTS_COUNT_RE.search(data)
+            if match:
+                self.results_count = int(re.sub(r"\D", "", match.group(1)))
+
+    def PopLinks(self):
+        """Returns the links found since the last call."""
+        links, self._links = self._links, []
+        return links
+
+
+def _ParseListingPage(resp):
+    """Returns the links of a fetched listing page and its
+    _ListingLinkExtractor."""
+    links = _ListingLinkExtractor()
+    links.feed(resp.body.decode(_ResponseCharset(resp), errors="replace"))
+    links.close()
+    return links.PopLinks(), links
+
+
+class _SeenUrls(object):
+    """A set of urls that only keeps a short digest of each of them."""
+
+    def __init__(self):
+        self._digests = set()
+
+    @staticmethod
+    def _Digest(url):
+        return hashlib.blake2b(url.encode("utf-8"), digest_size=8).digest()
+
+    def Add(self, url):
+        """Adds the url, returns whether it was not seen before."""
+        digest = self._Digest(url)
+        if digest in self._digests:
+            return False
+        self._digests.add(digest)
+        return True
+
+    def __contains__(self, url):
+        return self._Digest(url) in self._digests
+
+    def __len__(self):
+        return len(self._digests)
+
+
+def _ListingPageUrl(url, offset):
+    """Returns the url of the listing page at the given offset."""
+    return url + "&index=" + str(offset)
+
+
+class _ListingPagination(object):
+    """Decides which listing pages to fetch once the first one is parsed.
+
+    The first listing page tells the page size and, from its pagination links
+    or results count, the offset of the last listing page. The following
+    listing pages known to exist are all fetched, past them the pages are
+    probed one at a time until an empty one is found.
+    """
+
+    def __init__(self, start_offset, first_page):
+        """
+        Args:
+            start_offset: offset of the first listing page.
+            first_page: the _ListingLinkExtractor of the first listing page.
+        """
+        self.page_size = first_page.PageSize(start_offset)
+        self._last_offset = None
+        self._next_offset = start_offset + (self.page_size or 0)
+        if self.page_size:
+            self._last_offset = first_page.LastOffset(self.page_size)
+            logging.info(
+                "Listing pages have %d results, last page offset is %s",
+                self.page_size, self._last_offset)
+
+    def NextOffsets(self, num_in_flight, max_in_flight):
+        """Returns the offsets of the listing pages to fetch now.
+
+        Fetches all the pages known to exist, or probes the next one when
+        there is nothing else to wait for.
+
+        Args:
+            num_in_flight: number of listing pages being fetched.
+            max_in_flight: maximum number of listing pages fetched at once.
+        """
+        offsets = []
+        while num_in_flight + len(offsets) < max_in_flight and (
+                self._next_offset <= (self._last_offset or 0) or
+                not num_in_flight + len(offsets)):
+            offsets.append(self._next_offset)
+            self._next_offset += self.page_size
+        return offsets
+
+    def IsPastEnd(self, offset, listing_page, batch):
+        """Returns whether a fetched listing page ends the listing.
+
+        Args:
+            offset: offset of the listing page.
+            listing_page: its _ListingLinkExtractor.
+            batch: the pages it lists that were not listed before.
+        """
+        if not listing_page.num_links:
+            return True
+        self._last_offset = max(
+            self._last_offset or 0,
+            listing_page.LastOffset(self.page_size) or 0)
+        # Past the end, some sites serve the last page again.
+        return not batch and offset > self._last_offset
+
+
+def _ShardOf(page_url, num_shards):
+    """Returns the shard that owns a page, the same in every process."""
+    digest = hashlib.blake2b(page_url.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % num_shards
+
+
+def _ParseShard(value):
+    """Parses a shard given as "i/N" into an (index, count) tuple."""
+    index, sep, count = value.partition("/")
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        index = count = None
+    if not sep or count is None or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(
+            "shard must be i/N with 0 <= i < N, got %r" % value)
+    return index, count
+
+
+def _ResponseCharset(resp):
+    """Returns the charset of a fetcher.Response, utf-8 by default."""
+    match = re.search(
+        r"charset=[\"']?([\w.:-]+)", resp.headers.get("Content-Type") or "")
+    if match:
+        try:
+            return codecs.lookup(match.group(1)).name
+        except LookupError:
+            pass
+    return "utf-8"
+
+
+# Months as written on lecture pages, with and without accents.
+_FRENCH_MONTHS = {
+    "janvier": 1,
+    "février": 2, "fevrier": 2,
+    "mars": 3,
+    "avril": 4,
+    "mai": 5,
+    "juin": 6,
+    "juillet": 7,
+    "août": 8, "aout": 8,
+    "septembre": 9,
+    "octobre": 10,
+    "novembre": 11,
+    "décembre": 12, "decembre": 12,
+}
+
+
+@functools.lru_cache(maxsize=4096)
+def _ParseFrenchDate(text):
+    """Parses a French date like "29 juin 2017" or "1er Mai 2018".
+
+    Does not depend on the process locale. Lectures share a few thousand
+    distinct days so results are cached.
+
+    Returns:
+        A datetime.datetime at midnight of that day.
+    Raises:
+        ValueError: the text is not a French date.
+    """
+    parts = text.lower().split()
+    if len(parts) != 3 or parts[1] not in _FRENCH_MONTHS:
+        raise ValueError("Not a French date: %r" % text)
+    day, month, year = parts
+    if day.endswith("er"):
+        day = day[:-2]
+    return datetime.datetime(int(year), _FRENCH_MONTHS[month], int(day))
+
+
+@functools.lru_cache(maxsize=1024)
+def _ParseHour(text):
+    """Parses an hour like "17:00" into a number of seconds since midnight.
+
+    Raises:
+        ValueError: the text is None or not an hour.
+    """
+    if text is None:
+        raise ValueError("No hour")
+    hours, sep, minutes = text.partition(":")
+    if not sep or not hours.isdigit() or not minutes.isdigit():
+        raise ValueError("Not an hour: %r" % text)
+    hours, minutes = int(hours), int(minutes)
+    if hours > 23 or minutes > 59:
+        raise ValueError("Not an hour: %r" % text)
+    return 3600 * hours + 60 * minutes
+
+
+# Properties of lecture entities that are not extracted from their page.
+_UNFINGERPRINTED_PROPERTIES = frozenset(
+    ["Scraped", "Scheduled", "Converted", "Fingerprint"])
+
+
+def _Fingerprint(entity):
+    """Returns a digest of the properties of a lecture taken from its page.
+
+    It is a hex string rather than bytes so that it reads back the same
+    from every sink.
+    """
+    content = sorted(
+        (name, value) for name, value in entity.items()
+        if name not in _UNFINGERPRINTED_PROPERTIES)
+    return hashlib.sha1(json.dumps(
+        content, default=str, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _RetryAfter(headers):
+    """Returns the Retry-After delay of a response in seconds, if any."""
+    try:
+        return max(0.0, float(headers.get("Retry-After")))
+    except (AttributeError, TypeError, ValueError):
+        # Absent, or given as an HTTP date.
+        return None
+
+
+def _RssBytes():
+    """Returns the current resident set size of the process.
+
+    Returns:
+        A number of bytes, None where /proc is not available.
     """
     try:
-        return node.text.strip() or None
-    except AttributeError:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
         return None
 
 
+class _Answer(object):
+    """The response to a request, set once the host answered."""
+    __slots__ = ("resp",)
+
+    def __init__(self):
+        self.resp = None
+
+
+class _HostRateLimiter(object):
+    """Spaces out requests made to the same host, across threads.
+
+    The interval between two requests to a host adapts to how the host copes
+    with them, AIMD style. It doubles when the host answers with a 429 or 5xx
+    status, fails to answer, or answers slower than target_latency. After
+    every other answer, the request rate grows back by RATE_STEP requests per
+    second. The interval never gets shorter than 1 / max_qps nor than the
+    minimum interval set for the host, from its robots.txt for example.
+    """
+
+    # Requests per second added to the rate of a host after a good answer.
+    RATE_STEP = 0.5
+    # Interval of a host with no rate limit after its first congestion, and
+    # rate above which it is not limited anymore.
+    MIN_BACKOFF_SEC = 0.05
+    MAX_BACKOFF_SEC = 60.0
+
+    def __init__(self, max_qps, target_latency=None):
+        """
+        Args:
+            max_qps: maximum number of requests per second to send to a single
+                host, None or 0 to disable rate limiting.
+            target_latency: optional number of seconds above which an answer
+                is considered a sign that the host is overloaded.
+        """
+        self._default_interval = 1.0 / max_qps if max_qps else 0
+        self._target_latency = target_latency
+        self._lock = threading.Lock()
+        self._next_slot = {}
+        # Shortest interval allowed by host.
+        self._min_interval = {}
+        # Current interval by host, the shortest allowed if absent.
+        self._interval = {}
+
+    def _MinInterval(self, host):
+        return self._min_interval.get(host, self._default_interval)
+
+    def SetMinInterval(self, url, seconds):
+        """Never sends requests to the host of url closer than seconds apart."""
+        host = parse.urlsplit(url).netloc
+        with self._lock:
+            self._min_interval[host] = max(self._default_interval, seconds)
+            if self._interval.get(host, 0) < self._min_interval[host]:
+                self._interval.pop(host, None)
+
+    def Interval(self, url):
+        """Returns the current interval between requests to the host of url."""
+        host = parse.urlsplit(url).netloc
+        with self._lock:
+            return self._interval.get(host, self._MinInterval(host))
+
+    def Reserve(self, url):
+        """Reserves the next slot for a request to the host of url.
+
+        Returns:
+            The number of seconds to wait before sending the request.
+        """
+        host = parse.urlsplit(url).netloc
+        with self._lock:
+            interval = self._interval.get(host, self._MinInterval(host))
+            if not interval and host not in self._next_slot:
+                return 0
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + interval
+        return slot - now
+
+    def Wait(self, url):
+        """Blocks until a request to the host of the given url is allowed."""
+        delay = self.Reserve(url)
+        if delay > 0:
+            time.sleep(delay)
+
+    def Observe(self, url, seconds, status, retry_after=None):
+        """Adapts the interval of the host of url to one of its answers.
+
+        Args:
+            url: the requested url.
+            seconds: how long the host took to answer.
+            status: the HTTP status of the answer, None if there was none.
+            retry_after: optional number of seconds the host asked to wait
+                before the next request.
+        Returns:
+            Whether the host is considered overloaded.
+        """
+        host = parse.urlsplit(url).netloc
+        overloaded = (
+            status is None or status == 429 or status >= 500 or
+            bool(self._target_latency and seconds > self._target_latency))
+        with self._lock:
+            min_interval = self._MinInterval(host)
+            interval = self._interval.get(host, min_interval)
+            if overloaded:
+                interval = min(
+                    self.MAX_BACKOFF_SEC,
+                    max(2 * interval, min_interval, self.MIN_BACKOFF_SEC))
+            elif interval > min_interval:
+                interval = 1.0 / (1.0 / interval + self.RATE_STEP)
+                if interval < max(min_interval, self.MIN_BACKOFF_SEC):
+                    interval = min_interval
+            if interval == min_interval:
+                self._interval.pop(host, None)
+            else:
+                self._interval[host] = interval
+            if retry_after:
+                self._next_slot[host] = max(
+                    self._next_slot.get(host, 0),
+                    time.monotonic() + retry_after)
+        return overloaded
+
+
+class _BatchWriter(object):
+    """Write-behind buffer that saves entities with batched put_multi calls.
+
+    Not thread-safe, all writes are expected to come from the thread that
+    drives the crawl.
+    """
+
+    # Maximum number of entities in a single datastore commit.
+    MAX_BATCH_SIZE = 500
+
+    def __init__(
+        self, client, batch_size, dry_run, on_flush=None, crawl_metrics=None):
+        """
+        Args:
+            client: a datastore.Client or another sink from the sinks module.
+            batch_size: number of entities to buffer before writing them,
+                capped to MAX_BATCH_SIZE.
+            dry_run: dry run will only log the entities instead of writing
+                them.
+            on_flush: optional function called once buffered entities have
+                been written.
+            crawl_metrics: optional metrics.Metrics timing the writes.
+        """
+        self._client = client
+        self._batch_size = max(1, min(batch_size, self.MAX_BATCH_SIZE))
+        self._dry_run = dry_run
+        self._on_flush = on_flush
+        self._metrics = crawl_metrics or metrics.Metrics()
+        # Keyed by datastore key so that the same entity is never written
+        # twice in one commit, which datastore rejects.
+        self._pending = collections.OrderedDict()
+
+    def Pending(self, key):
+        """Returns the buffered entity with the given key, None if absent."""
+        return self._pending.get(key)
+
+    def Add(self, entity):
+        self._pending[entity.key] = entity
+        if len(self._pending) >= self._batch_size:
+            self.Flush()
+
+    def Flush(self):
+        if not self._pending:
+            return
+        entities = list(self._pending.values())
+        self._pending.clear()
+        if not self._dry_run:
+            with self._metrics.Time("datastore_put"):
+                self._client.put_multi(entities)
+            self._metrics.Increment("entities_written", len(entities))
+        else:
+            for entity in entities:
+                logging.debug("[dry run] %s", entity)
+        if self._on_flush:
+            with self._metrics.Time("frontier_commit"):
+                self._on_flush()
+
+
 class Scraper(object):
     def __init__(
         self, client, stop_when_present, user_agent, dry_run, overwrite,
-        robot_parser):
+        robot_parser, page_fetcher, concurrency=1, max_qps=None,
+        batch_size=_BatchWriter.MAX_BATCH_SIZE, html_parser="html.parser",
+        listing_concurrency=1, crawl_frontier=None,
+        site_url="http://www.college-de-france.fr", crawl_metrics=None,
+        shard=None, page_archive=None, target_latency=None,
+        robots_ttl=3600, max_rss_mb=None, max_retries=0):
         """
         Args:
-            client: a datastore.Client instance
+            client: a datastore.Client or another sink from the sinks module
+                to save lectures to.
             page_url: the url of the page to parse
             stop_when_present: whether to stop the crawl when the url has
                 already been imported in the datastore
@@ -35,6 +757,45 @@ class Scraper(object):
             overwrite: whether to overwrite already scraped entries
             robot_parser: a robotparser.RobotFileParser to use and respect
                 robots.txt directives.
+            page_fetcher: a fetcher.Fetcher or fetcher.CachingFetcher to
+                download pages with.
+            concurrency: number of lecture pages fetched and parsed in
+                parallel.
+            max_qps: maximum number of requests per second sent to a single
+                host, None for no limit. The rate is lowered further when
+                robots.txt asks for it or when the host gets slow or fails.
+            batch_size: number of entities written to the datastore in a
+                single call, at most 500.
+            html_parser: the parser used to extract lectures, one of
+                HTML_PARSERS.
+            listing_concurrency: number of listing pages fetched in parallel
+                once the number of listing pages is known.
+            crawl_frontier: optional frontier.Frontier recording the progress
+                of the crawl so that it can be resumed.
+            site_url: scheme and host of the scraped site, without trailing
+                slash.
+            crawl_metrics: optional metrics.Metrics recording the latency of
+                each stage of the crawl, a new one is used if None.
+            shard: optional (index, count) tuple, only the lectures owned by
+                that shard out of count are scraped. Every shard still reads
+                the whole listing.
+            page_archive: optional archive.Archive to store the raw lecture
+                pages in, so that they can be parsed again with Reparse.
+            target_latency: optional number of seconds above which a slow
+                answer makes the crawl slow down.
+            robots_ttl: number of seconds after which robots.txt is read
+                again, None to only read it once.
+            max_rss_mb: optional soft limit of the memory used by the
+                process. Above it, pending entities are written right away
+                and pages are no longer fetched or parsed ahead of the
+                stores until the process is below it again. Only enforced
+                where /proc tells the current memory use. The jsonl and
+                parquet sinks index every saved key in memory, their memory
+                still grows with the number of lectures.
+            max_retries: number of times a request answered with one of
+                fetcher.RETRIABLE_STATUSES is retried, after the back off of
+                the rate limit and the Retry-After of the answer. The
+                page_fetcher should then not retry these statuses itself.
         """
         self._client = client
         self._stop_when_present = stop_when_present
@@ -42,80 +803,588 @@ class Scraper(object):
         self._dry_run = dry_run
         self._overwrite = overwrite
         self._status = collections.Counter()
+        self._status_lock = threading.Lock()
         self._robot = robot_parser
+        self._robots_ttl = robots_ttl
+        self._max_retries = max_retries
+        self._robots_lock = threading.Lock()
+        self._robots_read_at = None
+        self._fetcher = page_fetcher
+        self._concurrency = max(1, concurrency)
+        self._html_parser = html_parser
+        self._listing_concurrency = max(1, listing_concurrency)
+        self._site_url = site_url
+        self._shard = shard
+        self._archive = page_archive
+        self._rate_limiter = _HostRateLimiter(max_qps, target_latency)
+        self._frontier = crawl_frontier
+        self._metrics = crawl_metrics or metrics.Metrics()
+        # Outcomes are only committed once the entities scraped before them
+        # are written, a resumed crawl never skips an entity that was lost.
+        self._writer = _BatchWriter(
+            client, batch_size, dry_run,
+            on_flush=crawl_frontier.Commit if crawl_frontier else None,
+            crawl_metrics=self._metrics)
+        # Pages already mapped to their entry in the datastore, the set of
+        # urls grows with the crawl so only their digests are kept.
+        self._known_pages = _SeenUrls()
+        # Pages to scrape again when resuming a crawl.
+        self._retry_pages = []
+        # Pages already scraped again, kept across calls of _SkipDonePages
+        # so that they are not scraped a second time when listed.
+        self._retried_pages = set()
+        # Set once the listing reached an already imported page.
+        self._listing_stopped = False
+        self._max_rss_bytes = max_rss_mb and max_rss_mb * 1024 * 1024
+        # Whether the process was above max_rss_mb when last checked.
+        self._over_memory = False
+
+    def _Count(self, status):
+        with self._status_lock:
+            self._status[status] += 1
+        self._metrics.Increment("pages", status=status)
+
+    def _Outcome(self, page_url, status):
+        """Counts the final status of a page and records it in the frontier."""
+        self._Count(status)
+        if self._frontier:
+            self._frontier.Record(page_url, status)
+
+    def _StatusSnapshot(self):
+        with self._status_lock:
+            return collections.Counter(self._status)
+
+    def _CheckMemory(self):
+        """Writes pending entities if the process is above max_rss_mb.
+
+        Called between the stores of two listing pages, sets _over_memory
+        for the stages to stop working ahead.
+        """
+        if not self._max_rss_bytes:
+            return
+        rss = _RssBytes()
+        if rss is None:
+            logging.warning(
+                "Memory use cannot be measured, max_rss_mb is ignored")
+            self._max_rss_bytes = None
+            return
+        over = rss > self._max_rss_bytes
+        if over:
+            self._writer.Flush()
+            gc.collect()
+            over = (_RssBytes() or 0) > self._max_rss_bytes
+        if over and not self._over_memory:
+            logging.warning(
+                "Above %d MB of memory, pages are no longer scraped ahead",
+                self._max_rss_bytes // (1024 * 1024))
+            self._metrics.Increment("memory_pressure")
+        self._over_memory = over
+
+    def _Fetch(self, url):
+        """Fetches the given url, respecting the per host rate limit.
+
+        Returns:
+            A fetcher.Response.
+        """
+        resp = self._Request(url, self._fetcher.Fetch, "fetch")
+        self._metrics.Increment("fetched_bytes", len(resp.body))
+        return resp
+
+    def _Stream(self, url):
+        """Same as _Fetch but the body is an iterator of chunks of bytes.
+
+        Only listing pages are streamed, the time until their body starts is
+        recorded as the listing_fetch stage.
+        """
+        return self._Request(url, self._fetcher.Stream, "listing_fetch")
+
+    def _Request(self, url, fetch, stage):
+        """Calls fetch(url) once the rate limit allows it.
+
+        The wait for the rate limit is recorded as the throttle stage, the
+        answer is observed by _Attempt. Overloaded answers are retried once
+        the adapted rate limit allows it.
+        """
+        for attempt in itertools.count():
+            with self._metrics.Time("throttle"):
+                self._rate_limiter.Wait(url)
+            with self._Attempt(url, stage, attempt) as answer:
+                answer.resp = fetch(url)
+            if answer.resp is not None:
+                return answer.resp
+
+    @contextlib.contextmanager
+    def _Attempt(self, url, stage, attempt):
+        """Observes the answer to the request made in the with block.
+
+        How long the host took to answer, and how, adapts the rate limit and
+        is recorded as the given stage. An overloaded answer that should be
+        retried is swallowed, the response is then left unset.
+
+        Args:
+            url: the requested url.
+            stage: the metrics stage to record the request in.
+            attempt: number of times the request was retried before.
+        Yields:
+            An _Answer whose resp the block sets to the response.
+        """
+        answer = _Answer()
+        start = time.monotonic()
+        status, retry_after = None, None
+        try:
+            yield answer
+            status = answer.resp.status
+        except error.HTTPError as e:
+            status, retry_after = e.code, _RetryAfter(e.headers)
+            if not self._ShouldRetry(url, e, attempt):
+                raise
+        finally:
+            seconds = time.monotonic() - start
+            self._metrics.Observe(stage, seconds)
+            self._ObserveAnswer(url, seconds, status, retry_after)
+
+    def _ShouldRetry(self, url, e, attempt):
+        """Returns whether to retry a request that failed with HTTPError e."""
+        if (e.code not in fetcher.RETRIABLE_STATUSES or
+                attempt >= self._max_retries):
+            return False
+        logging.warning("Fetch of %s returned %d, retrying", url, e.code)
+        self._metrics.Increment("retries")
+        return True
 
-    def Run(self, root_url):
+    def _ObserveAnswer(self, url, seconds, status, retry_after):
+        """Adapts the rate limit to an answer, see _HostRateLimiter.Observe."""
+        if self._rate_limiter.Observe(url, seconds, status, retry_after):
+            self._metrics.Increment("backoffs")
+            logging.info(
+                "Slowing down, next requests to %s are %.2f seconds apart",
+                parse.urlsplit(url).netloc, self._rate_limiter.Interval(url))
+
+    def _ReadRobots(self):
+        """Reads robots.txt and applies its crawl delay and request rate."""
+        with self._metrics.Time("robots_fetch"):
+            self._robot.read()
+        self._ApplyRobotsRates()
+
+    def _ApplyRobotsRates(self):
+        """Applies the crawl delay and request rate of robots.txt once read."""
+        self._robots_read_at = time.monotonic()
+        delay = self._robot.crawl_delay(self._user_agent) or 0
+        rate = self._robot.request_rate(self._user_agent)
+        if rate and rate.requests:
+            delay = max(delay, rate.seconds / rate.requests)
+        if delay:
+            logging.info(
+                "robots.txt asks for %.2f seconds between requests", delay)
+        # All the shards share the same host.
+        num_shards = self._shard[1] if self._shard else 1
+        self._rate_limiter.SetMinInterval(self._site_url, delay * num_shards)
+
+    def _CanFetch(self, url):
+        with self._metrics.Time("robots"), self._robots_lock:
+            # Rules are not read concurrently with checks, which could see
+            # them half parsed.
+            if self._robots_ttl and self._robots_read_at is not None and (
+                    time.monotonic() - self._robots_read_at > self._robots_ttl):
+                logging.info("Reading robots.txt again")
+                self._ReadRobots()
+            return self._robot.can_fetch(self._user_agent, url)
+
+    def Run(self, root_url, resume=False):
+        """Crawls the listing starting at root_url and imports its lectures.
+
+        Args:
+            root_url: url of the first listing page.
+            resume: whether to continue the crawl recorded in the frontier,
+                retrying its failed pages first, instead of starting over.
+        """
         logging.info("Parsing robots.txt")
-        self._robot.set_url("http://www.college-de-france.fr/robots.txt")
-        self._robot.read()
+        self._robot.set_url(self._site_url + "/robots.txt")
+        with self._robots_lock:
+            self._ReadRobots()
+        if self._shard:
+            logging.info("Crawling shard %d/%d", *self._shard)
+        listing_pages = self._FilterListing(
+            self._CollectListingPages(root_url, self._StartCrawl(resume)))
         logging.info("Starting collection of pages from root URL %s", root_url)
-        for page in self._CollectPages(root_url):
-            should_break_early, entity = self._ParsePage(page)
-            if should_break_early:
-                logging.info("Early exit as already scraped page has been found")
-                break
-            logging.debug("Saved entity: %s", entity)
-            logging.info(self._status)
+        # Pages are tagged with the offset of their listing page so that the
+        # existence of all the lectures of a listing page can be checked in a
+        # single datastore call.
+        pages = (
+            (offset, page)
+            for offset, batch in listing_pages
+            for page in batch)
+        if self._concurrency > 1:
+            results = self._ScrapeConcurrently(pages)
+        else:
+            results = map(self._ScrapeTaggedPage, pages)
+        finished = False
+        try:
+            for offset, group in itertools.groupby(
+                    results, key=lambda r: r[0]):
+                if self._StoreListingPage([scraped for _, scraped in group]):
+                    logging.info(
+                        "Early exit as already scraped page has been found")
+                    break
+                if self._frontier and offset is not None:
+                    self._frontier.ListingDone(offset)
+                logging.debug(self._StatusSnapshot())
+                self._CheckMemory()
+            finished = True
+        finally:
+            # Cancels the pages still queued in the thread pool if any.
+            if hasattr(results, "close"):
+                results.close()
+            self._FinishCrawl(finished)
+
+    def _FinishCrawl(self, finished):
+        """Writes what is left and records whether the crawl finished."""
+        self._writer.Flush()
+        if self._frontier:
+            self._frontier.Commit()
+            if finished:
+                self._frontier.MarkFinished()
+        logging.info("Pages by status: %s", dict(self._StatusSnapshot()))
+        logging.info("Crawl metrics: %s", json.dumps(self._metrics.Summary()))
 
-    def _ParsePage(self, page_url):
-        """Parses a single page containing a lecture.
+    def _StartCrawl(self, resume):
+        """Prepares the frontier for a new or resumed crawl.
 
         Returns:
-            A tuple (bool, entity) that contains whether the crawl should stop and the entity that was imported in the datastore if any.
+            The offset of the listing page to start the crawl from.
         """
-        logging.info("Parsing page %s", page_url)
-        if not self._robot.can_fetch(self._user_agent, page_url):
-            logging.info("Fetch of url disallowed by robots.txt")
-            self._status["disallowed"] += 1
+        if not self._frontier:
+            return 0
+        if not resume or self._frontier.IsFinished():
+            self._frontier.Reset()
+            return 0
+        self._retry_pages = self._frontier.PendingPages()
+        offset = self._frontier.LastListingOffset() or 0
+        logging.info(
+            "Resuming crawl at listing offset %d with %d pages to retry",
+            offset, len(self._retry_pages))
+        return offset
+
+    def _FilterListing(self, listing_pages):
+        """Drops the listed pages not to scrape, see _ShardPages,
+        _SkipDonePages and _SkipKnownPages.
+
+        A listing page with nothing left to scrape is recorded as done in the
+        frontier right away, it is never stored.
+        """
+        for offset, batch in self._SkipKnownPages(self._SkipDonePages(
+                self._ShardPages(listing_pages))):
+            if batch:
+                yield offset, batch
+            elif self._frontier and offset is not None:
+                self._frontier.ListingDone(offset)
+
+    def _ShardPages(self, listing_pages):
+        """Drops the pages owned by other shards.
+
+        Pages are assigned to shards by a hash of their url so that the
+        shards split the work evenly and never scrape the same page.
+
+        Args:
+            listing_pages: iterable of (listing page offset, list of pages
+                urls) tuples.
+        Yields:
+            (listing page offset, list of pages urls) tuples.
+        """
+        if not self._shard:
+            yield from listing_pages
+            return
+        index, count = self._shard
+        for offset, batch in listing_pages:
+            yield offset, [
+                page_url for page_url in batch
+                if _ShardOf(page_url, count) == index]
+
+    def _SkipDonePages(self, listing_pages):
+        """Drops the pages the frontier already has a final outcome for.
+
+        When resuming a crawl, the pages left pending or failed are yielded
+        first with a None offset.
+
+        Args:
+            listing_pages: iterable of (listing page offset, list of pages
+                urls) tuples.
+        Yields:
+            (listing page offset, list of pages urls) tuples.
+        """
+        if not self._frontier:
+            yield from listing_pages
+            return
+        retry_pages, self._retry_pages = self._retry_pages, []
+        if retry_pages:
+            self._retried_pages.update(retry_pages)
+            yield None, retry_pages
+        for offset, batch in listing_pages:
+            self._frontier.Discover(batch, offset)
+            done = self._frontier.DonePages(batch)
+            yield offset, [
+                page_url for page_url in batch
+                if page_url not in done and
+                page_url not in self._retried_pages]
+
+    def _ScrapeConcurrently(self, pages):
+        """Scrapes pages in a thread pool, yielding results in page order.
+
+        At most twice the concurrency pages are in flight at any time so that
+        the listing does not run too far ahead of the workers, a single one
+        when the process is above max_rss_mb. Results are
+        yielded in the same order as the pages so that the decision to stop
+        early is the same as in a sequential run, closing the generator
+        cancels all the pages that have not been started yet.
+        """
+        with futures.ThreadPoolExecutor(self._concurrency) as executor:
+            in_flight = collections.deque()
+            try:
+                for page in pages:
+                    in_flight.append(
+                        executor.submit(self._ScrapeTaggedPage, page))
+                    while len(in_flight) >= (
+                            1 if self._over_memory else 2 * self._concurrency):
+                        yield in_flight.popleft().result()
+                while in_flight:
+                    yield in_flight.popleft().result()
+            finally:
+                for future in in_flight:
+                    future.cancel()
+
+    def _SkipKnownPages(self, listing_pages):
+        """Drops the pages already imported before they are ever fetched.
+
+        Imported pages are recorded in the datastore as "Page" entities keyed
+        by their url and pointing to their "Entry", which lets a whole listing
+        page be checked with a single get_multi call instead of downloading
+        and parsing each lecture to compute its key.
+
+        Args:
+            listing_pages: iterable of (listing page offset, list of pages
+                urls) tuples as returned by _CollectListingPages.
+        Yields:
+            (listing page offset, list of pages urls) tuples of the pages
+            that need to be scraped.
+        """
+        for offset, batch in listing_pages:
+            known_entries = self._GetKnownEntries(batch)
+            pages_to_scrape = []
+            for page_url in batch:
+                if page_url not in known_entries:
+                    pages_to_scrape.append(page_url)
+                    continue
+                self._known_pages.Add(page_url)
+                entry = known_entries[page_url]
+                # Only overwrite entities which are not converted yet.
+                if self._overwrite and not entry.get("Converted"):
+                    pages_to_scrape.append(page_url)
+                    continue
+                logging.debug("Already saved %s", page_url)
+                self._Outcome(page_url, "present")
+                if self._stop_when_present and not self._overwrite:
+                    logging.info(
+                        "Early exit as already imported page has been listed")
+                    self._listing_stopped = True
+                    yield offset, pages_to_scrape
+                    return
+            yield offset, pages_to_scrape
+
+    def _GetKnownEntries(self, page_urls):
+        """Returns the entries already imported for the given pages.
+
+        Returns:
+            A dict of page url to its "Entry" entity, or to its "Page" entity
+            when the entry itself is not needed (no overwrite).
+        """
+        if not page_urls:
+            return {}
+        with self._metrics.Time("datastore_get"):
+            pages = self._client.get_multi(
+                [self._client.key("Page", page_url) for page_url in page_urls])
+        if not self._overwrite:
+            return {page.key.name: page for page in pages}
+        entry_pages = {page["Entry"]: page.key.name for page in pages}
+        if not entry_pages:
+            return {}
+        with self._metrics.Time("datastore_get"):
+            entries = self._client.get_multi(
+                [self._client.key("Entry", name) for name in entry_pages])
+        return {entry_pages[entry.key.name]: entry for entry in entries}
+
+    def _RememberPage(self, page_url, key):
+        """Records which entry the page was imported as, if not known yet."""
+        if page_url in self._known_pages:
+            return
+        page = datastore.Entity(
+            self._client.key("Page", page_url), exclude_from_indexes=["Entry"])
+        page["Entry"] = key.name
+        self._writer.Add(page)
+        self._known_pages.Add(page_url)
+
+    def _ScrapeTaggedPage(self, tagged_page):
+        tag, page_url = tagged_page
+        try:
+            return tag, self._ScrapePage(page_url)
+        except Exception:
+            # The page will be retried when the crawl is resumed.
+            logging.exception("Failed to scrape %s", page_url)
+            self._Outcome(page_url, "error")
+            return tag, None
+
+    def _StoreListingPage(self, scraped_pages, stop_early=True):
+        """Stores the scraped lectures of a listing page, in order.
+
+        Existence of all the lectures is checked with a single get_multi call.
+
+        Args:
+            scraped_pages: list of results of _ScrapePage.
+            stop_early: whether to stop at the first already imported lecture
+                when stop_when_present is set.
+        Returns:
+            Whether the crawl should stop.
+        """
+        scraped_pages = [scraped for scraped in scraped_pages if scraped]
+        keys = [key for _, key, _ in scraped_pages]
+        previous_entities = {}
+        if keys:
+            with self._metrics.Time("datastore_get"):
+                previous_entities = {
+                    entity.key: entity
+                    for entity in self._client.get_multi(keys)}
+        for scraped in scraped_pages:
+            _, key, _ = scraped
+            previous_entity = (
+                self._writer.Pending(key) or previous_entities.get(key))
+            should_break_early, _ = self._StorePage(scraped, previous_entity)
+            if should_break_early and stop_early:
+                return True
+        return False
+
+    def _StorePage(self, scraped, previous_entity):
+        """Queues the scraped entity for writing if it should be saved.
+
+        Args:
+            scraped: a (page_url, key, entity) tuple returned by _ScrapePage.
+            previous_entity: the entity already saved under the same key if
+                any.
+        Returns:
+            A tuple (bool, entity) that contains whether the crawl should stop and the entity that will be imported in the datastore if any.
+        """
+        page_url, key, entity = scraped
+        # If we already have it, skip.
+        if previous_entity:
+            logging.debug("Already saved %s", page_url)
+            self._Outcome(page_url, "present")
+            # Entries imported before pages were recorded are not known from
+            # the listing yet.
+            self._RememberPage(page_url, key)
+            # Only overwrite entities which are not converted yet.
+            if self._overwrite and previous_entity.get("Converted"):
+                return False, None
+            # Bail if we do not want to overwrite existing entities.
+            if not self._overwrite:
+                return self._stop_when_present, None
+            # Nothing to write if the page did not change since its import.
+            if entity is not None and (
+                    previous_entity.get("Fingerprint") ==
+                    entity["Fingerprint"]):
+                logging.debug("Unchanged %s", page_url)
+                self._Count("unchanged")
+                return False, None
+        if entity is None:
+            # TODO: Fix to 1H ? there are 2k source urls without end time...
+            self._Outcome(page_url, "no_duration")
             return False, None
-        resp = request.urlopen(
-            request.Request(
-                page_url, headers={'User-Agent': self._user_agent}))
-        s = BeautifulSoup(resp.read(), "html.parser")
+        if "Function" not in entity:
+            self._Count("no_function")
+        if "VideoLink" in entity:
+            self._Count("has_video")
+        if previous_entity:
+            self._Count("changed")
+        self._writer.Add(entity)
+        self._RememberPage(page_url, key)
+        logging.debug("Saved entity: %s", entity)
+        self._Outcome(page_url, "OK")
+        return False, entity
+
+    def _ScrapePage(self, page_url):
+        """Fetches and parses a single page containing a lecture.
+
+        This is safe to call from multiple threads, nothing is read from or
+        written to the datastore.
+
+        Returns:
+            A tuple (page_url, key, entity) or None if the page could not be
+            keyed. The entity is None if the lecture is incomplete.
+        """
+        logging.debug("Parsing page %s", page_url)
+        if not self._CanFetch(page_url):
+            logging.info("Fetch of url disallowed by robots.txt")
+            self._Outcome(page_url, "disallowed")
+            return None
+        return self._ScrapeResponse(page_url, self._Fetch(page_url))
+
+    def _ScrapeResponse(self, page_url, resp):
+        """Archives and parses a fetched lecture page.
+
+        Returns:
+            Same as _ScrapePage.
+        """
+        if self._archive and (
+                resp.status != 304 or not self._archive.Has(page_url)):
+            with self._metrics.Time("archive"):
+                self._archive.Put(page_url, resp.body)
+        # The page did not change since it was imported, no need to parse it
+        # again.
+        if resp.status == 304 and page_url in self._known_pages:
+            logging.debug("Not modified since last import %s", page_url)
+            self._Outcome(page_url, "not_modified")
+            return None
+        with self._metrics.Time("parse"):
+            fields = _ExtractLecture(resp.body, self._html_parser)
+        return self._LectureEntity(page_url, fields)
+
+    def _LectureEntity(self, page_url, fields):
+        """Builds the entity of a lecture from the fields of its page.
+
+        Args:
+            page_url: url of the lecture page.
+            fields: the fields returned by _ExtractLecture.
+        Returns:
+            A tuple (page_url, key, entity) or None if the page could not be
+            keyed. The entity is None if the lecture is incomplete.
+        """
         # Skip lessons without audio.
-        audio_link = s.find("li", "audio")
+        audio_link = fields.get("audio_link")
         if not audio_link:
             logging.warning("No audio link @ %s", page_url)
-            self._status["no_audio"] += 1
-            return False, None
-        audio_link = audio_link.find("a").get("href")
+            self._Outcome(page_url, "no_audio")
+            return None
         # Find key parts.
-        try:
-            lecturer = str(list(s.find("h3", "lecturer").children)[0]).strip()
-        except (IndexError, AttributeError):
+        lecturer = fields.get("lecturer")
+        if lecturer is None:
             logging.warning("No lecturer found, skipping")
-            self._status["no_key"] += 1
-            return False, None
-        try:
-            date = s.find("span", "day").text.strip()
-        except AttributeError:
+            self._Outcome(page_url, "no_key")
+            return None
+        date = fields.get("day")
+        if date is None:
             logging.warning("No date found, skipping")
-            self._status["no_key"] += 1
-            return False, None
-        try:
-            hour_start = s.find("span", "from").text.strip()
-        except AttributeError:
+            self._Outcome(page_url, "no_key")
+            return None
+        hour_start = fields.get("from")
+        if hour_start is None:
             logging.warning("No start hour found, skipping")
-            self._status["no_key"] += 1
-            return False, None
+            self._Outcome(page_url, "no_key")
+            return None
         # A single person cannot give two lessons starting at the same time
         # so hopefully this is a less brittle primary key than the audio link
         # or source url that could change anytime.
         key = self._client.key('Entry', "|".join([lecturer, date, hour_start]))
-        # If we already have it, skip.
-        previous_entity = self._client.get(key)
-        if previous_entity:
-            logging.info("Already saved %s", page_url)
-            self._status["present"] += 1
-            # Only overwrite entities which are not converted yet.
-            if self._overwrite and previous_entity.get("Converted"):
-                return False, None
-            # Bail if we do not want to overwrite existing entities.
-            if not self._overwrite:
-                return self._stop_when_present, None
         entity = datastore.Entity(
             key,
-            exclude_from_indexes=["VideoLink", "AudioLink", "source"])
+            exclude_from_indexes=[
+                "VideoLink", "AudioLink", "source", "Fingerprint"])
         entity.update({
             "Source": page_url,
             # We need those two here to index them and efficiently schedule
@@ -125,16 +1394,14 @@ class Scraper(object):
             # A random seed to be able to schedule random items.
             "Hash": hashlib.sha1(page_url.encode("utf-8")).digest(),
             "Scraped": datetime.datetime.utcnow(),
-            "Title": _trimmed_text(s.find(id="title")),
-            "TypeTitle": _trimmed_text(s.find("h4")),
-            "LessonType": _trimmed_text(s.find("span", "type")),
+            "Title": fields.get("title") or None,
+            "TypeTitle": fields.get("type_title") or None,
+            "LessonType": fields.get("type") or None,
             "Lecturer": lecturer,
             # Day is like "29 Juin 2017"
-            # The locale needs to be set to fr_FR for this to work.
-            "Date": datetime.datetime.fromtimestamp(
-                time.mktime(time.strptime(date, "%d %B %Y"))),
+            "Date": _ParseFrenchDate(date),
             "AudioLink": audio_link,
-            "Chaire": _trimmed_text(s.find("div", "chair-baseline"))
+            "Chaire": fields.get("chair") or None
         })
 
         # Audio links ends like "foo-bar-fr.mp3", language is at the end.
@@ -145,91 +1412,559 @@ class Scraper(object):
         else:
             entity["Language"] = "fr"
 
-        try:
-            entity["Function"] = list(
-                s.find("h3", "lecturer").children)[1].text.strip()
-        except (AttributeError, IndexError):
-            # No function, okay.
-            self._status["no_function"] += 1
-            pass
+        # No function is okay.
+        if fields.get("function") is not None:
+            entity["Function"] = fields["function"]
 
         # Parse duration of the audio.
         try:
-            hour_end = s.find("span", "to").text.strip()
-            time_from = time.strptime(hour_start, "%H:%M")
-            time_end = time.strptime(hour_end, "%H:%M")
             # There are no lessons that ends the next day so this works.
-            entity["DurationSec"] = int(
-                (
-                    datetime.timedelta(
-                        hours=time_end.tm_hour, minutes=time_end.tm_min)
-                    - datetime.timedelta(
-                        hours=time_from.tm_hour, minutes=time_from.tm_min)
-                ).total_seconds())
-        except (AttributeError, ValueError):
+            entity["DurationSec"] = (
+                _ParseHour(fields.get("to")) - _ParseHour(hour_start))
+        except ValueError:
             logging.info("No end or wrong hour found, skipping")
-            # TODO: Fix to 1H ? there are 2k source urls without end time...
-            self._status["no_duration"] += 1
-            return False, None
+            return page_url, key, None
 
-        video_link = s.find("li", "video")
+        video_link = fields.get("video_link")
         if video_link:
-            entity["VideoLink"] = video_link.find("a").get("href")
-            self._status["has_video"] += 1
+            entity["VideoLink"] = video_link
 
-        # Save entity finally.
-        if not self._dry_run:
-            self._client.put(entity)
-        else:
-            logging.debug("[dry run] %s", entity)
-        self._status["OK"] += 1
-        return False, entity
+        # Lets a refresh skip the lectures that did not change.
+        entity["Fingerprint"] = _Fingerprint(entity)
+        return page_url, key, entity
+
+    # Number of archived pages parsed by a process at once.
+    _REPARSE_CHUNK_SIZE = 64
+
+    def Reparse(self, page_archive, processes=None):
+        """Extracts the lectures of all the archived pages again.
+
+        Nothing is fetched, pages are parsed in parallel across processes and
+        their entities are stored like in Run: entries already imported are
+        only replaced when overwrite is set, and only if not converted yet.
+        stop_when_present is ignored.
+
+        Pages are sent to the processes in chunks, at most two chunks per
+        process are parsed ahead of the stores, a single one when the process
+        is above max_rss_mb, so that memory does not grow with the archive.
+
+        Args:
+            page_archive: the archive.Archive to read pages from.
+            processes: number of parsing processes, one per CPU if None.
+        """
+        batch_size = self._writer.MAX_BATCH_SIZE
+        workers = processes or os.cpu_count() or 1
+        paths = page_archive.Paths()
+        scraped_pages = []
+        try:
+            with futures.ProcessPoolExecutor(processes) as executor:
+                in_flight = collections.deque()
+                try:
+                    while True:
+                        while len(in_flight) < (
+                                1 if self._over_memory else 2 * workers):
+                            chunk = list(itertools.islice(
+                                paths, self._REPARSE_CHUNK_SIZE))
+                            if not chunk:
+                                break
+                            in_flight.append(executor.submit(
+                                _ExtractArchivedLectures, chunk,
+                                self._html_parser))
+                        if not in_flight:
+                            break
+                        for page_url, fields, seconds in (
+                                in_flight.popleft().result()):
+                            self._metrics.Observe("parse", seconds)
+                            scraped_pages.append(
+                                self._ArchivedLectureEntity(page_url, fields))
+                        if len(scraped_pages) >= batch_size:
+                            self._StoreListingPage(
+                                scraped_pages, stop_early=False)
+                            scraped_pages = []
+                            self._CheckMemory()
+                    self._StoreListingPage(scraped_pages, stop_early=False)
+                finally:
+                    for future in in_flight:
+                        future.cancel()
+        finally:
+            self._writer.Flush()
+            logging.info("Pages by status: %s", dict(self._StatusSnapshot()))
+            logging.info(
+                "Reparse metrics: %s", json.dumps(self._metrics.Summary()))
+
+    def _ArchivedLectureEntity(self, page_url, fields):
+        """Same as _LectureEntity, a page that fails counts as an error.
+
+        Args:
+            page_url: url of the archived page.
+            fields: as returned by _ExtractArchivedLecture.
+        """
+        try:
+            if fields is None:
+                raise ValueError("Lecture could not be extracted")
+            return self._LectureEntity(page_url, fields)
+        except Exception:
+            logging.exception("Failed to reparse %s", page_url)
+            self._Outcome(page_url, "error")
+            return None
+
+    def _CollectListingPages(self, url, start_offset=0):
+        """Collect pages with audio in them from the listing pages.
 
-    def _CollectPages(self, url):
-        """Collect pages with audio in them from the given root url.
+        The first listing page is parsed incrementally as its chunks arrive
+        so that lectures can be scraped before it is fully downloaded. The
+        following listing pages, see _ListingPagination, are then fetched in
+        parallel, in waves of listing_concurrency pages. Pages already listed
+        are only yielded once.
 
         Args:
             url: url to start the crawl from
+            start_offset: offset of the first listing page to fetch.
         Yields:
-            pages urls to individual lessons
+            (listing page offset, list of pages urls to individual lessons)
+            tuples in listing order, a listing page can span several
+            consecutive tuples.
         """
-        if not self._robot.can_fetch(self._user_agent, url):
+        if not self._CanFetch(url):
             logging.warning("Fetch of root url disallowed by robots.txt")
-        maybe_more_content = True
-        num_pages = 0
-        while maybe_more_content:
-            resp = request.urlopen(
-                request.Request(
-                    url + "&index=" + str(num_pages),
-                    headers={'User-Agent': self._user_agent}))
-            s = BeautifulSoup(resp.read(), "html.parser")
-            maybe_more_content = False
-            for link in s.find_all("a"):
-                href = link.get("href")
-                if href.startswith("/site/"):
-                    yield "http://www.college-de-france.fr" + href
-                    num_pages += 1
-                    maybe_more_content = True
+        seen = _SeenUrls()
+        first_page = _ListingLinkExtractor()
+        for hrefs in self._StreamListingPage(
+                _ListingPageUrl(url, start_offset), first_page):
+            batch = self._NewListedPages(hrefs, seen)
+            if batch:
+                yield start_offset, batch
+        pagination = _ListingPagination(start_offset, first_page)
+        if not pagination.page_size:
+            return
+        with futures.ThreadPoolExecutor(self._listing_concurrency) as executor:
+            in_flight = collections.deque()
+            try:
+                while True:
+                    for offset in pagination.NextOffsets(
+                            len(in_flight), self._listing_concurrency):
+                        in_flight.append((offset, executor.submit(
+                            self._FetchListingPage,
+                            _ListingPageUrl(url, offset))))
+                    offset, future = in_flight.popleft()
+                    hrefs, listing_page = future.result()
+                    batch = self._NewListedPages(hrefs, seen)
+                    if pagination.IsPastEnd(offset, listing_page, batch):
+                        break
+                    if batch:
+                        yield offset, batch
+            finally:
+                for _, future in in_flight:
+                    future.cancel()
+
+    def _NewListedPages(self, hrefs, seen):
+        return [
+            self._site_url + href
+            for href in hrefs
+            if seen.Add(href)]
+
+    def _StreamListingPage(self, page_url, links):
+        """Feeds a listing page to the link extractor as it downloads.
+
+        Args:
+            page_url: url of the listing page.
+            links: a _ListingLinkExtractor.
+        Yields:
+            lists of links found in each chunk of the page.
+        """
+        resp = self._Stream(page_url)
+        decoder = codecs.getincrementaldecoder(
+            _ResponseCharset(resp))(errors="replace")
+        for chunk in itertools.chain(resp.body, [None]):
+            if chunk is None:
+                links.feed(decoder.decode(b"", final=True))
+                links.close()
+            else:
+                links.feed(decoder.decode(chunk))
+            hrefs = links.PopLinks()
+            if hrefs:
+                yield hrefs
+
+    def _FetchListingPage(self, page_url):
+        """Returns the links of a listing page and its _ListingLinkExtractor."""
+        links = _ListingLinkExtractor()
+        hrefs = [
+            href
+            for chunk_hrefs in self._StreamListingPage(page_url, links)
+            for href in chunk_hrefs]
+        return hrefs, links
+
+
+class AsyncScraper(Scraper):
+    """Same as Scraper but fetches pages from a single asyncio event loop.
+
+    Up to concurrency lecture pages are in flight at once without a thread
+    each. Pages are parsed and lectures stored in the default executor of the
+    loop so that it never blocks, extraction, filters, outcomes and storage
+    are shared with Scraper.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Args:
+            Same as Scraper, page_fetcher is a fetcher.AsyncFetcher, it is
+            closed at the end of Run.
+        """
+        super().__init__(*args, **kwargs)
+        self._robots_reading = None
+
+    def Run(self, root_url, resume=False):
+        """Same as Scraper.Run, on a new event loop."""
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self._RunAsync(root_url, resume))
+        finally:
+            loop.close()
+
+    async def _RunAsync(self, root_url, resume):
+        loop = asyncio.get_event_loop()
+        self._robots_reading = asyncio.Lock()
+        logging.info("Parsing robots.txt")
+        self._robot.set_url(self._site_url + "/robots.txt")
+        await self._ReadRobotsAsync()
+        if self._shard:
+            logging.info("Crawling shard %d/%d", *self._shard)
+        logging.info("Starting collection of pages from root URL %s", root_url)
+        semaphore = asyncio.Semaphore(self._concurrency)
+        # Tasks of the pages in listing order, grouped by the offset of their
+        # listing page.
+        pending = collections.deque()
+        num_pending = 0
+        listing = self._ListedPagesAsync(root_url, self._StartCrawl(resume))
+        finished = False
+        try:
+            stop = False
+            async for offset, batch in listing:
+                tasks = [
+                    asyncio.ensure_future(
+                        self._ScrapePageAsync(page_url, semaphore))
+                    for page_url in batch]
+                if pending and pending[-1][0] == offset:
+                    pending[-1][1].extend(tasks)
+                else:
+                    pending.append((offset, tasks))
+                num_pending += len(tasks)
+                # A listing page is only complete once the next one is
+                # listed. The listing does not run too far ahead of the
+                # fetches, like in Scraper._ScrapeConcurrently.
+                while len(pending) > 1 and (
+                        num_pending >= 2 * self._concurrency or
+                        self._over_memory):
+                    num_pending -= len(pending[0][1])
+                    stop = await self._StoreTasksAsync(*pending.popleft())
+                    if stop:
+                        break
+                if stop:
+                    break
+            while pending and not stop:
+                stop = await self._StoreTasksAsync(*pending.popleft())
+            finished = True
+        finally:
+            for _, tasks in pending:
+                for task in tasks:
+                    task.cancel()
+            await asyncio.gather(
+                *[task for _, tasks in pending for task in tasks],
+                return_exceptions=True)
+            await listing.aclose()
+            await self._fetcher.Close()
+            await loop.run_in_executor(None, self._FinishCrawl, finished)
+
+    async def _StoreTasksAsync(self, offset, tasks):
+        """Stores the lectures of a listing page once they are all scraped.
+
+        Returns:
+            Whether the crawl should stop.
+        """
+        loop = asyncio.get_event_loop()
+        scraped_pages = await asyncio.gather(*tasks)
+        if await loop.run_in_executor(
+                None, self._StoreListingPage, scraped_pages):
+            logging.info("Early exit as already scraped page has been found")
+            return True
+        if self._frontier and offset is not None:
+            self._frontier.ListingDone(offset)
+        logging.debug(self._StatusSnapshot())
+        await loop.run_in_executor(None, self._CheckMemory)
+        return False
+
+    async def _ListedPagesAsync(self, root_url, start_offset):
+        """Async version of _FilterListing(_CollectListingPages(...)).
+
+        The filters look up the datastore, they are run in the executor one
+        listed batch at a time.
+        """
+        loop = asyncio.get_event_loop()
+        listing = self._CollectListingPagesAsync(root_url, start_offset)
+        try:
+            async for listed in listing:
+                batches = await loop.run_in_executor(
+                    None, lambda: list(self._FilterListing([listed])))
+                for offset, batch in batches:
+                    yield offset, batch
+                if self._listing_stopped:
+                    return
+        finally:
+            await listing.aclose()
+
+    async def _ReadRobotsAsync(self):
+        """Same as _ReadRobots, robots.txt is fetched with the async fetcher.
+
+        Errors are handled like RobotFileParser.read does.
+        """
+        with self._metrics.Time("robots_fetch"):
+            try:
+                resp = await self._fetcher.Fetch(self._robot.url)
+            except error.HTTPError as e:
+                if e.code in (401, 403):
+                    self._robot.disallow_all = True
+                elif 400 <= e.code < 500:
+                    self._robot.allow_all = True
+            else:
+                self._robot.parse(
+                    resp.body.decode("utf-8", errors="replace").splitlines())
+        self._ApplyRobotsRates()
+
+    async def _CanFetchAsync(self, url):
+        async with self._robots_reading:
+            if self._robots_ttl and (
+                    time.monotonic() - self._robots_read_at >
+                    self._robots_ttl):
+                logging.info("Reading robots.txt again")
+                await self._ReadRobotsAsync()
+        with self._metrics.Time("robots"):
+            return self._robot.can_fetch(self._user_agent, url)
+
+    async def _FetchAsync(self, url, stage="fetch"):
+        """Same as _Request, waits for the rate limit without blocking."""
+        for attempt in itertools.count():
+            with self._metrics.Time("throttle"):
+                delay = self._rate_limiter.Reserve(url)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            with self._Attempt(url, stage, attempt) as answer:
+                answer.resp = await self._fetcher.Fetch(url)
+            if answer.resp is not None:
+                break
+        self._metrics.Increment("fetched_bytes", len(answer.resp.body))
+        return answer.resp
+
+    async def _ScrapePageAsync(self, page_url, semaphore):
+        """Same as _ScrapeTaggedPage without the tag.
+
+        At most concurrency pages are fetched at once, parsing happens in
+        the executor.
+        """
+        try:
+            async with semaphore:
+                logging.debug("Parsing page %s", page_url)
+                if not await self._CanFetchAsync(page_url):
+                    logging.info("Fetch of url disallowed by robots.txt")
+                    self._Outcome(page_url, "disallowed")
+                    return None
+                resp = await self._FetchAsync(page_url)
+            return await asyncio.get_event_loop().run_in_executor(
+                None, self._ScrapeResponse, page_url, resp)
+        except asyncio.CancelledError:
+            # The crawl stopped early, the page is not scraped but did not
+            # fail. CancelledError is an Exception before Python 3.8.
+            raise
+        except Exception:
+            # The page will be retried when the crawl is resumed.
+            logging.exception("Failed to scrape %s", page_url)
+            self._Outcome(page_url, "error")
+            return None
+
+    async def _CollectListingPagesAsync(self, url, start_offset=0):
+        """Same as _CollectListingPages.
+
+        The first listing page is not parsed as it downloads, the following
+        ones are fetched in waves of listing_concurrency pages.
+        """
+        if not await self._CanFetchAsync(url):
+            logging.warning("Fetch of root url disallowed by robots.txt")
+        seen = _SeenUrls()
+        hrefs, first_page = await self._FetchListingPageAsync(
+            _ListingPageUrl(url, start_offset))
+        batch = self._NewListedPages(hrefs, seen)
+        if batch:
+            yield start_offset, batch
+        pagination = _ListingPagination(start_offset, first_page)
+        if not pagination.page_size:
+            return
+        in_flight = collections.deque()
+        try:
+            while True:
+                for offset in pagination.NextOffsets(
+                        len(in_flight), self._listing_concurrency):
+                    in_flight.append((offset, asyncio.ensure_future(
+                        self._FetchListingPageAsync(
+                            _ListingPageUrl(url, offset)))))
+                offset, task = in_flight.popleft()
+                hrefs, listing_page = await task
+                batch = self._NewListedPages(hrefs, seen)
+                if pagination.IsPastEnd(offset, listing_page, batch):
+                    break
+                if batch:
+                    yield offset, batch
+        finally:
+            for _, task in in_flight:
+                task.cancel()
+
+    async def _FetchListingPageAsync(self, page_url):
+        """Same as _FetchListingPage, the page is parsed in the executor."""
+        resp = await self._FetchAsync(page_url, "listing_fetch")
+        return await asyncio.get_event_loop().run_in_executor(
+            None, _ParseListingPage, resp)
+
+
+def _RunShard(args, shard=None, crawl_metrics=None):
+    """Runs the crawl, or the reparse, of the command line arguments.
+
+    Args:
+        args: the parsed command line arguments.
+        shard: optional (index, count) tuple of the shard to crawl.
+        crawl_metrics: optional metrics.Metrics to record the crawl in.
+    Returns:
+        The metrics.Metrics of the crawl.
+    """
+    crawl_metrics = crawl_metrics or metrics.Metrics()
+    # Shards run from a process pool each get their own files.
+    suffix = ".shard-%d" % shard[0] if shard and not args.shard else ""
+    num_shards = shard[1] if shard else 1
+    if args.sink == "datastore":
+        logging.info("Creating client for project %s", args.project_id)
+    client = sinks.Open(
+        args.sink, args.sink_path and args.sink_path + suffix,
+        args.project_id)
+    fetcher_class = (
+        fetcher.AsyncFetcher if args.use_asyncio else fetcher.Fetcher)
+    # Overloaded answers are retried by the scraper, through its rate limit.
+    page_fetcher = fetcher_class(
+        args.user_agent, timeout=args.timeout, max_retries=args.max_retries,
+        retry_statuses=())
+    if args.http_cache_dir:
+        page_fetcher = fetcher.CachingFetcher(
+            page_fetcher, args.http_cache_dir + suffix,
+            args.http_cache_max_mb * 1024 * 1024)
+    if args.metrics_port:
+        crawl_metrics.Serve(args.metrics_port + (shard[0] if suffix else 0))
+    # Shared by all the shards, pages are archived under their own name.
+    page_archive = (
+        archive.Archive(args.archive_dir) if args.archive_dir else None)
+    scraper_class = AsyncScraper if args.use_asyncio else Scraper
+    s = scraper_class(
+        client,
+        args.stop_when_present,
+        args.user_agent,
+        args.dry_run,
+        args.overwrite,
+        robotparser.RobotFileParser(),
+        page_fetcher,
+        concurrency=args.concurrency,
+        # All the shards share the same host.
+        max_qps=args.max_qps / num_shards,
+        batch_size=args.batch_size,
+        html_parser=args.html_parser,
+        listing_concurrency=args.listing_concurrency,
+        crawl_frontier=(
+            frontier.Frontier(args.frontier + suffix)
+            if args.frontier and not args.reparse else None),
+        crawl_metrics=crawl_metrics,
+        shard=shard,
+        page_archive=page_archive,
+        target_latency=args.target_latency,
+        robots_ttl=args.robots_ttl,
+        max_rss_mb=args.max_rss_mb,
+        max_retries=args.max_retries)
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    try:
+        if args.reparse:
+            s.Reparse(page_archive, args.processes)
+        else:
+            s.Run(args.root_url, resume=args.resume)
+    finally:
+        if args.sink != "datastore":
+            client.close()
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile + suffix)
+            logging.info("Wrote profile to %s", args.profile + suffix)
+    return crawl_metrics
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--project_id", help="Google Cloud Project ID.")
     parser.add_argument("--dry_run", help="Dry runs will not import parsed pages in the datastore.", action="store_true")
+    parser.add_argument("--sink", help="Where to save lectures, the local sinks do not need a Google Cloud project.", choices=sinks.SINKS, default="datastore")
+    parser.add_argument("--sink_path", help="File, or directory for parquet, the local sinks save lectures to.")
     parser.add_argument("--user_agent", help="user agent string to use, be nice and tell other people why they are being scraped.")
     parser.add_argument("--stop_when_present", help="Stop crawl when the first already imported item is found (useful after the first run).", action="store_true")
     parser.add_argument("--overwrite", help="Overwrite already imported entries if they are not converted already.", action="store_true")
+    parser.add_argument("--concurrency", help="Number of lecture pages fetched and parsed in parallel.", type=int, default=1)
+    parser.add_argument("--max_qps", help="Maximum number of requests per second sent to the scraped host, shared by all the shards.", type=float, default=2.0)
+    parser.add_argument("--target_latency", help="Seconds above which an answer of the scraped host is considered a sign of overload, the crawl slows down like on 429 and 5xx errors.", type=float, default=2.0)
+    parser.add_argument("--robots_ttl", help="Seconds after which robots.txt is read again.", type=float, default=3600)
+    parser.add_argument("--use_asyncio", help="Fetch lecture pages from a single asyncio event loop instead of a thread each, --concurrency is the number of requests in flight.", action="store_true")
+    parser.add_argument("--max_rss_mb", help="Soft limit of the memory used by each crawling process in megabytes, above it entities are written right away and pages are no longer scraped ahead. Needs /proc, the key index of the jsonl and parquet sinks still grows with the crawl.", type=float)
+    parser.add_argument("--batch_size", help="Number of entities written to the datastore in a single call (at most 500).", type=int, default=500)
+    parser.add_argument("--timeout", help="Timeout in seconds of HTTP requests.", type=float, default=30)
+    parser.add_argument("--max_retries", help="Number of times failed HTTP requests are retried.", type=int, default=3)
+    parser.add_argument("--http_cache_dir", help="Directory of the on-disk HTTP cache, pages are revalidated with conditional requests and unchanged lectures are not parsed again.")
+    parser.add_argument("--http_cache_max_mb", help="Maximum size of the HTTP cache in megabytes.", type=int, default=512)
+    parser.add_argument("--html_parser", help="Parser used to extract lectures, lxml is faster.", choices=HTML_PARSERS, default="html.parser")
+    parser.add_argument("--listing_concurrency", help="Number of listing pages fetched in parallel.", type=int, default=4)
+    parser.add_argument("--frontier", help="Path of a SQLite database recording the progress of the crawl, put it on a persistent volume.")
+    parser.add_argument("--resume", help="Resume the crawl recorded in --frontier, retrying its failed pages, instead of starting over.", action="store_true")
     parser.add_argument("--root_url", help="Root URL to start the crawl from.", default="http://www.college-de-france.fr/components/search-audiovideo.jsp?fulltext=&siteid=1156951719600&lang=FR&type=audio")
+    parser.add_argument("--log_level", help="Logging level, DEBUG logs every page.", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO")
+    parser.add_argument("--metrics_port", help="Port to serve metrics on in the Prometheus text format while the crawl runs.", type=int)
+    parser.add_argument("--metrics_json", help="Path of a file to write a JSON summary of the metrics to at the end of the crawl.")
+    parser.add_argument("--shard", help="Only scrape the lectures of shard i out of N, given as i/N, lectures are split by a hash of their url.", type=_ParseShard)
+    parser.add_argument("--processes", help="Number of processes to split the crawl in, each one crawling its own shard. With --reparse, number of processes parsing pages, one per CPU by default.", type=int)
+    parser.add_argument("--archive_dir", help="Directory to archive the raw lecture pages in, compressed and keyed by the SHA-1 of their url.")
+    parser.add_argument("--reparse", help="Extract lectures again from the pages in --archive_dir instead of crawling the site, use --overwrite to update imported entries.", action="store_true")
+    parser.add_argument("--profile", help="Path of a file to write cProfile stats of the run to, only the main thread is profiled so use --concurrency=1 to see the scraping of lectures.")
     args = parser.parse_args()
-    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.DEBUG)
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=getattr(logging, args.log_level))
 
-    locale.setlocale(locale.LC_ALL, 'fr_FR.UTF-8')
-    logging.info("Creating client for project %s", args.project_id)
-    client = datastore.Client(args.project_id)
-    s = Scraper(
-        client,
-        args.stop_when_present,
-        args.user_agent,
-        args.dry_run,
-        args.overwrite,
-        robotparser.RobotFileParser())
-    s.Run(args.root_url)
+    if args.shard and (args.processes or 1) > 1:
+        parser.error("--shard and --processes cannot be used together")
+    if args.sink != "datastore" and not args.sink_path:
+        parser.error("--sink=%s needs --sink_path" % args.sink)
+    if args.reparse and not args.archive_dir:
+        parser.error("--reparse needs --archive_dir")
+    if args.reparse and args.shard:
+        parser.error("--shard cannot be used with --reparse")
+    if args.resume and not args.frontier:
+        parser.error("--resume needs --frontier")
+    if args.html_parser == "lxml" and etree is None:
+        parser.error("--html_parser=lxml needs lxml, pip install lxml")
+    if args.use_asyncio and args.http_cache_dir:
+        parser.error("--http_cache_dir cannot be used with --use_asyncio")
+
+    crawl_metrics = metrics.Metrics()
+    try:
+        if (args.processes or 1) > 1 and not args.reparse:
+            shards = [(i, args.processes) for i in range(args.processes)]
+            with futures.ProcessPoolExecutor(args.processes) as executor:
+                for shard_metrics in executor.map(
+                        _RunShard, itertools.repeat(args), shards):
+                    crawl_metrics.Merge(shard_metrics)
+            logging.info(
+                "Crawl metrics of all shards: %s",
+                json.dumps(crawl_metrics.Summary()))
+        else:
+            _RunShard(args, args.shard, crawl_metrics)
+    finally:
+        if args.metrics_json:
+            with open(args.metrics_json, "w") as f:
+                json.dump(crawl_metrics.Summary(), f, indent=2)
@@ -1,35 +1,28 @@
-from urllib import request
+from urllib import error
 from urllib import robotparser
+import argparse
+import asyncio
 import unittest
 from unittest.mock import patch
 from unittest.mock import create_autospec
 from unittest.mock import call
 from unittest.mock import MagicMock
-import io
-import locale
 import logging
+import os
+import tempfile
 import time
 import datetime
 
+import archive
+import fetcher
+import frontier
+import metrics
 import scraper
+import sinks
 from google.cloud import datastore
 
-@patch.object(request, "urlopen")
-class TestScraper(unittest.TestCase):
-    def setUp(self):
-        self._mock_client = create_autospec(datastore.Client)
-        self._mock_robot = create_autospec(robotparser.RobotFileParser)
-        self._mock_robot.can_fetch.return_value = True
-        self._scraper = scraper.Scraper(
-            self._mock_client,
-            True, # stop_when_present
-            'Morzina',
-            False, # dry_run
-            False, # overwrite
-            self._mock_robot)
-        self._headers = {'User-Agent': 'Morzina'}
-        # HTML copy pasted almost verbatim (minus noisy head tags).
-        self._page_io = io.StringIO("""
+# HTML copy pasted almost verbatim (minus noisy head tags).
+LECTURE_PAGE = """
         <!doctype html>
         <body>
         <header id="head">
@@ -150,84 +143,295 @@ class TestScraper(unittest.TestCase):
         </main>
         	</body>
         </html>
-                            """)
+                            """
+
 
-    def test_two_links_on_first_page(self, mock_url_open):
-        mock_url_open.side_effect = (
-            io.StringIO("""
+class _FakeAsyncFetcher(object):
+    """Serves pages by url like a fetcher.AsyncFetcher, 404 for the others."""
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.fetched = []
+        self.closed = False
+
+    async def Fetch(self, url, headers=None):
+        self.fetched.append(url)
+        await asyncio.sleep(0)
+        if url not in self.pages:
+            raise error.HTTPError(url, 404, "Not Found", {}, None)
+        return fetcher.Response(url, 200, {}, self.pages[url].encode("utf-8"))
+
+    async def Close(self):
+        self.closed = True
+
+
+class TestScraper(unittest.TestCase):
+    def setUp(self):
+        self._mock_client = create_autospec(datastore.Client)
+        self._mock_robot = create_autospec(robotparser.RobotFileParser)
+        self._mock_robot.can_fetch.return_value = True
+        self._mock_robot.crawl_delay.return_value = None
+        self._mock_robot.request_rate.return_value = None
+        self._mock_fetcher = create_autospec(fetcher.Fetcher)
+        self._mock_client.key.side_effect = (
+            lambda kind, name: datastore.Key(kind, name, project="test"))
+        self._scraper = scraper.Scraper(
+            self._mock_client,
+            True, # stop_when_present
+            'Morzina',
+            False, # dry_run
+            False, # overwrite
+            self._mock_robot,
+            self._mock_fetcher)
+        self._headers = {'User-Agent': 'Morzina'}
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp_dir.cleanup)
+        self._page = self._Response(LECTURE_PAGE)
+
+    def _Response(self, body):
+        return fetcher.Response(
+            "http:///page/url", 200, {}, body.encode("utf-8"))
+
+    def _StreamResponse(self, body, chunk_size=16):
+        body = body.encode("utf-8")
+        return fetcher.Response(
+            "http:///page/url", 200, {}, iter([
+                body[i:i + chunk_size]
+                for i in range(0, len(body), chunk_size)]))
+
+    def _ScrapeAndStore(self, page_url):
+        """Scrapes and stores a single page like Run does.
+
+        Returns:
+            A tuple (bool, entity) that contains whether the crawl should
+            stop and the scraped entity if any.
+        """
+        scraped = self._scraper._ScrapePage(page_url)
+        stop_when_present = self._scraper._StoreListingPage([scraped])
+        self._scraper._writer.Flush()
+        return stop_when_present, scraped and scraped[2]
+
+    def _SetSaved(self, **properties):
+        """Makes the client find saved entries with the given properties."""
+        def GetMulti(keys):
+            found = []
+            for key in keys:
+                if key.kind == "Entry":
+                    entity = datastore.Entity(key)
+                    entity.update(properties)
+                    found.append(entity)
+            return found
+        self._mock_client.get_multi.side_effect = GetMulti
+
+    def test_two_links_on_first_page(self):
+        self._mock_fetcher.Stream.side_effect = (
+            self._StreamResponse("""
             <body>
             <a href="/site/url1"></a>
             <a href="/not/a/good/url"></a>
+            <a name="no-href"></a>
             <a href="/site/url2"></a>
             </body>
             """),
-            io.StringIO("empty second page"))
+            self._StreamResponse("empty second page"))
         root = "http:///root/?foo=bar"
-        pages = list(self._scraper._CollectPages(root))
+        pages = [
+            page
+            for _, batch in self._scraper._CollectListingPages(root)
+            for page in batch]
         self.assertSequenceEqual(
             ("http://www.college-de-france.fr/site/url1",
              "http://www.college-de-france.fr/site/url2"),
             pages)
-        self.assertEqual(2, mock_url_open.call_count)
+        self.assertEqual(2, self._mock_fetcher.Stream.call_count)
+
+    def test_links_yielded_while_streaming_and_only_once(self):
+        first_page = self._StreamResponse(
+            '<a href="/site/url1"></a>' + " " * 100 +
+            '<a href="/site/url2"></a><a href="/site/url1"></a>')
+        self._mock_fetcher.Stream.side_effect = (
+            first_page,
+            self._StreamResponse('<a href="/site/url2"></a>'),
+            self._StreamResponse("empty third page"))
+        listing = self._scraper._CollectListingPages("http:///root/?foo=bar")
+        self.assertEqual(
+            (0, ["http://www.college-de-france.fr/site/url1"]), next(listing))
+        # The rest of the first page is not downloaded yet.
+        self.assertTrue(next(first_page.body, None))
+        self.assertEqual(
+            [(0, ["http://www.college-de-france.fr/site/url2"])], list(listing))
+        # Duplicated links do not count in the page size.
+        self.assertEqual(
+            "http:///root/?foo=bar&index=2",
+            self._mock_fetcher.Stream.call_args_list[1][0][0])
+
+    def test_listing_pages_fetched_in_parallel_from_pagination(self):
+        self._scraper = scraper.Scraper(
+            self._mock_client,
+            True, # stop_when_present
+            'Morzina',
+            False, # dry_run
+            False, # overwrite
+            self._mock_robot,
+            self._mock_fetcher,
+            listing_concurrency=3)
+        pagination = "".join(
+            '<a href="search.jsp?type=audio&index=%d">%d</a>' % (i, i)
+            for i in (2, 6))
+        pages = {
+            0: '<header><a href="/site/menu.htm">menu</a></header>'
+               '<a href="/site/0"></a><a href="/site/1"></a>' + pagination,
+            2: '<a href="/site/2"></a><a href="/site/3"></a>' + pagination,
+            4: '<a href="/site/4"></a><a href="/site/5"></a>' + pagination,
+            6: '<a href="/site/6"></a>' + pagination,
+        }
+        self._mock_fetcher.Stream.side_effect = lambda url: (
+            self._StreamResponse(pages.get(int(url.rsplit("=", 1)[1]), "")))
+        listing = list(
+            self._scraper._CollectListingPages("http:///root/?foo=bar"))
+        self.assertEqual(
+            [(i // 2 * 2, "http://www.college-de-france.fr/site/%d" % i)
+             for i in range(7)],
+            [(index, page) for index, batch in listing for page in batch])
+        fetched = sorted(
+            int(c[0][0].rsplit("=", 1)[1])
+            for c in self._mock_fetcher.Stream.call_args_list)
+        # Plus a probe after the last known page.
+        self.assertEqual([0, 2, 4, 6, 8], fetched)
+
+    def test_page_size_read_from_pagination(self):
+        pagination = "".join(
+            '<a href="search.jsp?type=audio&index=%d">%d</a>' % (i, i)
+            for i in (0, 2, 4))
+        # Each result also links to its chair.
+        pages = {
+            offset: "".join(
+                '<a href="/site/%d"></a><a href="/site/chair-%d"></a>' % (
+                    i, i)
+                for i in range(offset, min(offset + 2, 5))) + pagination
+            for offset in (0, 2, 4)
+        }
+        self._mock_fetcher.Stream.side_effect = lambda url: (
+            self._StreamResponse(pages.get(int(url.rsplit("=", 1)[1]), "")))
+        listing = self._scraper._CollectListingPages("http:///root/?foo=bar")
+        self.assertEqual(
+            ["http://www.college-de-france.fr/site/%d" % i for i in range(5)],
+            [page for _, batch in listing for page in batch
+             if "chair" not in page])
+        self.assertEqual(
+            [0, 2, 4, 6],
+            [int(c[0][0].rsplit("=", 1)[1])
+             for c in self._mock_fetcher.Stream.call_args_list])
 
-    def test_already_scraped(self, mock_url_open):
-        mock_url_open.return_value = self._page_io
-        self._mock_client.get.return_value = {
-            "Converted": False, "Title": "A lesson"}
-        stop_when_present, _ = self._scraper._ParsePage("http:///page/url")
+    def test_page_size_without_next_page_link(self):
+        listing_page = scraper._ListingLinkExtractor()
+        listing_page.feed(
+            '<a href="/site/0"></a><a href="/site/1"></a>'
+            '<a href="search.jsp?type=audio&index=8">Last</a>')
+        self.assertEqual(2, listing_page.PageSize(0))
+        self.assertEqual(8, listing_page.LastOffset(2))
+
+    def test_listing_stops_when_pages_repeat_past_the_end(self):
+        pages = {
+            0: '<a href="/site/0"></a><a href="/site/1"></a>',
+            2: '<a href="/site/2"></a><a href="/site/3"></a>',
+            4: '<a href="/site/4"></a>',
+        }
+        # Out of range indexes get the last page again.
+        self._mock_fetcher.Stream.side_effect = lambda url: (
+            self._StreamResponse(pages[min(4, int(url.rsplit("=", 1)[1]))]))
+        listing = self._scraper._CollectListingPages("http:///root/?foo=bar")
+        self.assertEqual(
+            ["http://www.college-de-france.fr/site/%d" % i for i in range(5)],
+            [page for _, batch in listing for page in batch])
+        self.assertEqual(4, self._mock_fetcher.Stream.call_count)
+
+    def test_already_scraped(self):
+        self._mock_fetcher.Fetch.return_value = self._page
+        self._SetSaved(Converted=False, Title="A lesson")
+        stop_when_present, _ = self._ScrapeAndStore("http:///page/url")
         self.assertTrue(stop_when_present)
-        self._mock_client.put.assert_not_called()
+        self.assertEqual([], self._SavedEntities("Entry"))
+        # The page is recorded so that it is skipped from the listing next time.
+        page, = self._SavedEntities("Page")
+        self.assertEqual("http:///page/url", page.key.name)
+        self.assertEqual(
+            "Alain Wijffels|29 juin 2017|17:00", page["Entry"])
 
-    def test_robot_txt_disallowed(self, mock_url_open):
+    def test_robot_txt_disallowed(self):
         self._mock_robot.can_fetch.return_value = False
-        stop_when_present, entity = self._scraper._ParsePage("http:///page/url")
+        stop_when_present, entity = self._ScrapeAndStore("http:///page/url")
         self.assertFalse(stop_when_present)
         self.assertFalse(entity)
-        self._mock_client.put.assert_not_called()
+        self._mock_client.put_multi.assert_not_called()
 
-    def test_already_scraped_overwrite(self, mock_url_open):
+    def test_already_scraped_overwrite(self):
         self._scraper = scraper.Scraper(
             self._mock_client,
             True, # stop_when_present
             'Morzina',
             False, # dry_run
             True, # overwrite
-            self._mock_robot)
-        mock_url_open.return_value = self._page_io
-        self._mock_client.get.return_value = {
-            "Converted": False, "Title": "A lesson"}
-        stop_when_present, ent = self._scraper._ParsePage("http:///page/url")
+            self._mock_robot,
+            self._mock_fetcher)
+        self._mock_fetcher.Fetch.return_value = self._page
+        self._SetSaved(Converted=False, Title="A lesson")
+        stop_when_present, ent = self._ScrapeAndStore("http:///page/url")
         self.assertFalse(stop_when_present)
-        self._mock_client.put.assert_called_once_with(ent)
+        self.assertEqual([ent], self._SavedEntities("Entry"))
 
-    def test_already_scraped_overwrite_converted(self, mock_url_open):
+    def test_overwrite_skips_unchanged_entities(self):
         self._scraper = scraper.Scraper(
             self._mock_client,
             True, # stop_when_present
             'Morzina',
             False, # dry_run
             True, # overwrite
-            self._mock_robot)
-        mock_url_open.return_value = self._page_io
-        self._mock_client.get.return_value = {
-            "Converted": True, "Title": "A lesson"}
-        stop_when_present, ent = self._scraper._ParsePage("http:///page/url")
+            self._mock_robot,
+            self._mock_fetcher)
+        self._mock_fetcher.Fetch.return_value = self._page
+        _, _, ent = self._scraper._ScrapePage("http:///page/url")
+        self.assertEqual(40, len(ent["Fingerprint"]))
+        self._SetSaved(
+            Converted=False, Fingerprint=ent["Fingerprint"], Scheduled=True)
+        stop_when_present, _ = self._ScrapeAndStore("http:///page/url")
         self.assertFalse(stop_when_present)
-        self._mock_client.put.assert_not_called()
+        self.assertEqual([], self._SavedEntities("Entry"))
+        self.assertEqual(1, self._scraper._status["unchanged"])
+        # A changed page is written again.
+        self._mock_fetcher.Fetch.return_value = self._Response(
+            LECTURE_PAGE.replace("directeur de recherche CNRS<", "CNRS<"))
+        _, ent = self._ScrapeAndStore("http:///page/url")
+        self.assertEqual([ent], self._SavedEntities("Entry"))
+        self.assertEqual(1, self._scraper._status["changed"])
 
-    def testNoAudioLink(self, mock_url_open):
-        mock_url_open.return_value = io.StringIO("an empty page")
-        self._mock_client.get.return_value = {
-            "Converted": False, "Title": "A lesson"}
-        stop_when_present, _ = self._scraper._ParsePage("http:///page/url")
+    def test_already_scraped_overwrite_converted(self):
+        self._scraper = scraper.Scraper(
+            self._mock_client,
+            True, # stop_when_present
+            'Morzina',
+            False, # dry_run
+            True, # overwrite
+            self._mock_robot,
+            self._mock_fetcher)
+        self._mock_fetcher.Fetch.return_value = self._page
+        self._SetSaved(Converted=True, Title="A lesson")
+        stop_when_present, ent = self._ScrapeAndStore("http:///page/url")
         self.assertFalse(stop_when_present)
-        self._mock_client.put.assert_not_called()
+        self.assertEqual([], self._SavedEntities("Entry"))
 
-    def testSavesEntity(self, mock_url_open):
-        mock_url_open.return_value = self._page_io
-        self._mock_client.get.return_value = None
-        stop_when_present, ent = self._scraper._ParsePage("http:///page/url")
-        self._mock_client.put.assert_called_once_with(ent)
+    def testNoAudioLink(self):
+        self._mock_fetcher.Fetch.return_value = self._Response(
+            "an empty page")
+        self._SetSaved(Converted=False, Title="A lesson")
+        stop_when_present, _ = self._ScrapeAndStore("http:///page/url")
+        self.assertFalse(stop_when_present)
+        self._mock_client.put_multi.assert_not_called()
+
+    def testSavesEntity(self):
+        self._mock_fetcher.Fetch.return_value = self._page
+        stop_when_present, ent = self._ScrapeAndStore("http:///page/url")
+        self.assertEqual([ent], self._SavedEntities("Entry"))
         self.assertEqual("http:///page/url", ent["Source"])
         self.assertTrue(ent["Scraped"])
         self.assertEqual("Pour une culture juridique européenne", ent["Title"])
@@ -244,8 +448,604 @@ class TestScraper(unittest.TestCase):
         self.assertEqual("fr", ent["Language"])
         self.assertEqual("Chaire Européenne (2016-2017)", ent["Chaire"])
 
+    def test_stages_are_timed(self):
+        crawl_metrics = metrics.Metrics()
+        self._scraper = scraper.Scraper(
+            self._mock_client,
+            True, # stop_when_present
+            'Morzina',
+            False, # dry_run
+            False, # overwrite
+            self._mock_robot,
+            self._mock_fetcher,
+            crawl_metrics=crawl_metrics)
+        self._mock_fetcher.Fetch.return_value = self._page
+        self._ScrapeAndStore("http:///page/url")
+        summary = crawl_metrics.Summary()
+        for stage in (
+                "robots", "throttle", "fetch", "parse", "datastore_get",
+                "datastore_put"):
+            self.assertEqual(1, summary["stages"][stage]["count"], stage)
+        self.assertEqual(
+            {
+                "entities_written": 2,
+                "fetched_bytes": len(self._page.body),
+                'pages{status="OK"}': 1,
+                'pages{status="has_video"}': 1,
+            },
+            dict(summary["counters"]))
+
+    def test_fetch_is_timed_without_the_rate_limit(self):
+        crawl_metrics = metrics.Metrics()
+        self._scraper = scraper.Scraper(
+            self._mock_client,
+            True, # stop_when_present
+            'Morzina',
+            False, # dry_run
+            False, # overwrite
+            self._mock_robot,
+            self._mock_fetcher,
+            crawl_metrics=crawl_metrics)
+        self._mock_fetcher.Fetch.return_value = self._page
+        with patch.object(
+                self._scraper._rate_limiter, "Wait",
+                side_effect=lambda url: time.sleep(0.05)):
+            self._scraper._Fetch("http:///page/url")
+        stages = crawl_metrics.Summary()["stages"]
+        self.assertGreaterEqual(stages["throttle"]["total_sec"], 0.05)
+        self.assertLess(stages["fetch"]["total_sec"], 0.05)
+
+    def test_retries_overloaded_answers_through_the_rate_limit(self):
+        crawl_metrics = metrics.Metrics()
+        self._scraper = scraper.Scraper(
+            self._mock_client,
+            True, # stop_when_present
+            'Morzina',
+            False, # dry_run
+            False, # overwrite
+            self._mock_robot,
+            self._mock_fetcher,
+            crawl_metrics=crawl_metrics,
+            max_retries=1)
+        too_many = error.HTTPError(
+            "http:///page/url", 429, "Too Many Requests",
+            {"Retry-After": "30"}, None)
+        self._mock_fetcher.Fetch.side_effect = [too_many, self._page]
+        with patch.object(scraper.time, "sleep") as mock_sleep:
+            self.assertEqual(self._page, self._scraper._Fetch("http:///page/url"))
+        # The retry waited for the Retry-After of the answer.
+        self.assertAlmostEqual(30, mock_sleep.call_args[0][0], places=0)
+        counters = crawl_metrics.Summary()["counters"]
+        self.assertEqual(1, counters["retries"])
+        self.assertEqual(1, counters["backoffs"])
+        # Not retried once the retries are exhausted.
+        self._mock_fetcher.Fetch.side_effect = [too_many, too_many]
+        with patch.object(scraper.time, "sleep"), \
+             self.assertRaises(error.HTTPError):
+            self._scraper._Fetch("http:///page/url")
+
+    def test_saves_to_local_sink(self):
+        sink = sinks.Open(
+            "sqlite", os.path.join(self._tmp_dir.name, "sink.db"))
+        self.addCleanup(sink.close)
+        self._scraper = scraper.Scraper(
+            sink,
+            True, # stop_when_present
+            'Morzina',
+            False, # dry_run
+            False, # overwrite
+            self._mock_robot,
+            self._mock_fetcher)
+        self._mock_fetcher.Fetch.return_value = self._page
+        _, ent = self._ScrapeAndStore("http:///page/url")
+        self.assertEqual("Alain Wijffels", sink.get(ent.key)["Lecturer"])
+        self.assertEqual(
+            ent.key.name, sink.get(sink.key("Page", "http:///page/url"))["Entry"])
+        # Already saved the second time.
+        stop_when_present, _ = self._ScrapeAndStore("http:///page/url")
+        self.assertTrue(stop_when_present)
+
+    def test_not_modified_known_page_is_not_parsed(self):
+        self._mock_fetcher.Fetch.return_value = self._page._replace(status=304)
+        self._scraper._known_pages.Add("http:///page/url")
+        self.assertIsNone(self._scraper._ScrapePage("http:///page/url"))
+        self.assertEqual(1, self._scraper._status["not_modified"])
+        # Unknown pages are parsed even if they did not change.
+        self.assertIsNotNone(self._scraper._ScrapePage("http:///other/url"))
+
+    def test_archives_fetched_pages(self):
+        page_archive = archive.Archive(self._tmp_dir.name)
+        self._scraper._archive = page_archive
+        self._mock_fetcher.Fetch.return_value = self._page
+        self._scraper._ScrapePage("http:///page/url")
+        self.assertEqual(self._page.body, page_archive.Get("http:///page/url"))
+
+    def test_reparse_from_archive(self):
+        page_archive = archive.Archive(self._tmp_dir.name)
+        page_archive.Put("http:///page/1", self._page.body)
+        page_archive.Put("http:///page/2", b"an empty page")
+        page_archive.Put(
+            "http:///page/3",
+            self._page.body.replace(b"29 juin", b"29 juinn"))
+        page_archive.Put("http:///page/4", b"corrupt")
+        with open(page_archive._Path("http:///page/4"), "wb") as f:
+            f.write(b"not gzip")
+        self._mock_client.get_multi.return_value = []
+        self._scraper.Reparse(page_archive, processes=2)
+        self._mock_fetcher.Fetch.assert_not_called()
+        self.assertEqual(
+            ["http:///page/1"],
+            [e["Source"] for e in self._SavedEntities("Entry")])
+        self.assertEqual(1, self._scraper._status["no_audio"])
+        # Bad pages do not stop the reparse.
+        self.assertEqual(2, self._scraper._status["error"])
+
+    def test_extract_lecture_parsers_agree(self):
+        expected = {
+            "audio_link": "http://www.college-de-france.fr/audio/alain-wijffels/2017/alain-wijffels.2017-06-29-17-00-00-a-fr.mp3",
+            "video_link": "http://www.college-de-france.fr/video/alain-wijffels/2017/lc-wijffels-20170629.mp4",
+            "lecturer": "Alain Wijffels",
+            "function": "Historien du droit, Professeur aux universités de Leyde, Louvain et Louvain-la-Neuve, directeur de recherche CNRS",
+            "day": "29 juin 2017",
+            "from": "17:00",
+            "to": "18:00",
+            "type": "Leçon de clôture",
+            "title": "Pour une culture juridique européenne",
+            "type_title": "Pour une culture juridique européenne",
+            "chair": "Chaire Européenne (2016-2017)",
+        }
+        body = LECTURE_PAGE.encode("utf-8")
+        self.assertEqual(expected, scraper._ExtractLecture(body, "html.parser"))
+        if scraper.etree is not None:
+            self.assertEqual(expected, scraper._ExtractLecture(body, "lxml"))
+
+    def test_extract_lecture_first_match_only(self):
+        fields = scraper._ExtractLecture("""
+            <h3 class="lecturer"> Nobody<span>A <b>very</b> nice person</span>
+                <span>Ignored</span></h3>
+            <h3 class="lecturer">Somebody else</h3>
+            <span class="day"><span>29</span> juin 2017</span>
+            <span class="day">30 juin 2017</span>
+            <li class="audio"><ul><li>nested</li></ul><a href="a.mp3">a</a></li>
+            """)
+        self.assertEqual("29 juin 2017", fields["day"])
+        self.assertEqual("a.mp3", fields["audio_link"])
+        self.assertEqual("A very nice person", fields["function"])
+        self.assertEqual("Nobody", fields["lecturer"])
+        self.assertNotIn("video_link", fields)
+
+    def _SavedEntities(self, kind):
+        return [
+            entity
+            for c in self._mock_client.put_multi.call_args_list
+            for entity in c[0][0]
+            if entity.key.kind == kind]
+
+    def test_skips_known_pages_before_fetching(self):
+        self._mock_client.get_multi.side_effect = lambda keys: [
+            datastore.Entity(key) for key in keys
+            if key.kind == "Page" and key.name == "http:///page/2"]
+        listing = [(0, ["http:///page/1", "http:///page/2", "http:///page/3"])]
+        with patch.object(
+                self._scraper, "_CollectListingPages",
+                return_value=iter(listing)), \
+             patch.object(
+                 self._scraper, "_ScrapePage",
+                 side_effect=self._MakeScrapedPage) as mock_scrape:
+            self._scraper.Run("http:///root/?foo=bar")
+        # Stops at the known page without fetching it.
+        mock_scrape.assert_called_once_with("http:///page/1")
+        self.assertEqual(
+            ["http:///page/1"],
+            [e["Source"] for e in self._SavedEntities("Entry")])
+        self.assertEqual(
+            ["http:///page/1"],
+            [e.key.name for e in self._SavedEntities("Page")])
+
+    def test_resume_retries_failed_pages_and_skips_done_ones(self):
+        crawl_frontier = create_autospec(frontier.Frontier)
+        crawl_frontier.IsFinished.return_value = False
+        crawl_frontier.PendingPages.return_value = ["http:///page/failed"]
+        crawl_frontier.LastListingOffset.return_value = 20
+        crawl_frontier.DonePages.return_value = {"http:///page/done"}
+        self._scraper = scraper.Scraper(
+            self._mock_client,
+            True, # stop_when_present
+            'Morzina',
+            False, # dry_run
+            False, # overwrite
+            self._mock_robot,
+            self._mock_fetcher,
+            crawl_frontier=crawl_frontier)
+        self._mock_client.get_multi.return_value = []
+        listing = [(20, ["http:///page/done", "http:///page/new"])]
+        with patch.object(
+                self._scraper, "_CollectListingPages",
+                return_value=iter(listing)) as mock_collect, \
+             patch.object(
+                 self._scraper, "_ScrapePage",
+                 side_effect=self._MakeScrapedPage) as mock_scrape:
+            self._scraper.Run("http:///root/?foo=bar", resume=True)
+        mock_collect.assert_called_once_with("http:///root/?foo=bar", 20)
+        self.assertEqual(
+            [call("http:///page/failed"), call("http:///page/new")],
+            mock_scrape.call_args_list)
+        crawl_frontier.Reset.assert_not_called()
+        crawl_frontier.Record.assert_any_call("http:///page/new", "OK")
+        crawl_frontier.ListingDone.assert_called_once_with(20)
+        crawl_frontier.MarkFinished.assert_called_once_with()
+
+    def test_known_listing_page_is_done(self):
+        crawl_frontier = create_autospec(frontier.Frontier)
+        crawl_frontier.DonePages.return_value = set()
+        self._scraper = scraper.Scraper(
+            self._mock_client,
+            False, # stop_when_present
+            'Morzina',
+            False, # dry_run
+            False, # overwrite
+            self._mock_robot,
+            self._mock_fetcher,
+            crawl_frontier=crawl_frontier)
+        self._mock_client.get_multi.side_effect = lambda keys: [
+            datastore.Entity(key) for key in keys
+            if key.kind == "Page" and key.name != "http:///page/new"]
+        listing = [
+            (0, ["http:///page/1", "http:///page/2"]),
+            (20, ["http:///page/new"]),
+        ]
+        with patch.object(
+                self._scraper, "_CollectListingPages",
+                return_value=iter(listing)), \
+             patch.object(
+                 self._scraper, "_ScrapePage",
+                 side_effect=self._MakeScrapedPage) as mock_scrape:
+            self._scraper.Run("http:///root/?foo=bar")
+        mock_scrape.assert_called_once_with("http:///page/new")
+        self.assertEqual(
+            [call(0), call(20)], crawl_frontier.ListingDone.call_args_list)
+
+    def _MakeScrapedPage(self, page_url):
+        key = datastore.Key("Entry", page_url, project="test")
+        entity = datastore.Entity(key)
+        entity["Source"] = page_url
+        return page_url, key, entity
+
+    def test_concurrent_run_stops_in_page_order(self):
+        self._scraper = scraper.Scraper(
+            self._mock_client,
+            True, # stop_when_present
+            'Morzina',
+            False, # dry_run
+            False, # overwrite
+            self._mock_robot,
+            self._mock_fetcher,
+            concurrency=4,
+            batch_size=3)
+        listing = [
+            (j // 2, ["http:///page/%d" % (i + 5 * j) for i in range(5)])
+            for j in range(4)]
+        present = self._MakeScrapedPage("http:///page/15")[2]
+        self._mock_client.get_multi.side_effect = lambda keys: [
+            present] if present.key in keys else []
+        with patch.object(
+                self._scraper, "_CollectListingPages",
+                return_value=iter(listing)), \
+             patch.object(
+                 self._scraper, "_ScrapePage",
+                 side_effect=self._MakeScrapedPage):
+            self._scraper.Run("http:///root/?foo=bar")
+        # One lookup of pages per batch and one of entries per listing page.
+        self.assertEqual(6, self._mock_client.get_multi.call_count)
+        saved = [entity["Source"] for entity in self._SavedEntities("Entry")]
+        self.assertEqual(
+            ["http:///page/%d" % i for i in range(15)], saved)
+        # Entries and their pages, plus the page of the present entry.
+        self.assertEqual(
+            [3] * 10 + [1], [
+                len(c[0][0])
+                for c in self._mock_client.put_multi.call_args_list])
+
+    def test_memory_ceiling_writes_entities_right_away(self):
+        crawl_metrics = metrics.Metrics()
+        self._scraper = scraper.Scraper(
+            self._mock_client,
+            True, # stop_when_present
+            'Morzina',
+            False, # dry_run
+            False, # overwrite
+            self._mock_robot,
+            self._mock_fetcher,
+            concurrency=4,
+            crawl_metrics=crawl_metrics,
+            max_rss_mb=100)
+        listing = [
+            (j, ["http:///page/%d" % (i + 2 * j) for i in range(2)])
+            for j in range(3)]
+        self._mock_client.get_multi.return_value = []
+        with patch.object(
+                self._scraper, "_CollectListingPages",
+                return_value=iter(listing)), \
+             patch.object(
+                 self._scraper, "_ScrapePage",
+                 side_effect=self._MakeScrapedPage), \
+             patch.object(scraper, "_RssBytes", return_value=200 << 20):
+            self._scraper.Run("http:///root/?foo=bar")
+        # Entries and their pages are written after every listing page.
+        self.assertEqual(
+            [4, 4, 4], [
+                len(c[0][0])
+                for c in self._mock_client.put_multi.call_args_list])
+        self.assertEqual(
+            1, crawl_metrics.Summary()["counters"]["memory_pressure"])
+
+    def test_memory_ceiling_follows_current_memory(self):
+        self._scraper = scraper.Scraper(
+            self._mock_client,
+            True, # stop_when_present
+            'Morzina',
+            False, # dry_run
+            False, # overwrite
+            self._mock_robot,
+            self._mock_fetcher,
+            max_rss_mb=100)
+        with patch.object(scraper, "_RssBytes", return_value=200 << 20):
+            self._scraper._CheckMemory()
+        self.assertTrue(self._scraper._over_memory)
+        with patch.object(scraper, "_RssBytes", return_value=50 << 20):
+            self._scraper._CheckMemory()
+        self.assertFalse(self._scraper._over_memory)
+        # Not enforced when the current memory use is unknown.
+        with patch.object(scraper, "_RssBytes", return_value=None):
+            self._scraper._CheckMemory()
+        self.assertFalse(self._scraper._over_memory)
+        self.assertIsNone(self._scraper._max_rss_bytes)
+
+    def test_shards_split_pages(self):
+        pages = ["http:///page/%d" % i for i in range(100)]
+        listing = [(0, pages[:50]), (50, pages[50:])]
+        sharded = []
+        for index in range(3):
+            self._scraper._shard = (index, 3)
+            shard_pages = [
+                page
+                for _, batch in self._scraper._ShardPages(iter(listing))
+                for page in batch]
+            # Pages are spread over all the shards.
+            self.assertGreater(len(shard_pages), 10)
+            sharded.extend(shard_pages)
+        self.assertEqual(pages, sorted(sharded, key=pages.index))
+        self.assertEqual(
+            [0, 1, 1], [scraper._ShardOf("http:///page/2", n) for n in (1, 2, 3)])
+
+    def test_parse_shard(self):
+        self.assertEqual((2, 4), scraper._ParseShard("2/4"))
+        for value in ("4/4", "-1/4", "2", "a/b"):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                scraper._ParseShard(value)
+
+    def test_parse_french_date_without_locale(self):
+        self.assertEqual(
+            datetime.datetime(2017, 6, 29),
+            scraper._ParseFrenchDate("29 juin 2017"))
+        self.assertEqual(
+            datetime.datetime(2018, 2, 1),
+            scraper._ParseFrenchDate("1er Février 2018"))
+        self.assertEqual(
+            datetime.datetime(2016, 8, 15),
+            scraper._ParseFrenchDate("15 aout 2016"))
+        for text in ("29 June 2017", "juin 2017", "le 29 juin"):
+            with self.assertRaises(ValueError):
+                scraper._ParseFrenchDate(text)
+
+    def test_parse_hour(self):
+        self.assertEqual(17 * 3600 + 30 * 60, scraper._ParseHour("17:30"))
+        self.assertEqual(9 * 3600, scraper._ParseHour("9:00"))
+        for text in (None, "", "17h00", "25:00", "17:"):
+            with self.assertRaises(ValueError):
+                scraper._ParseHour(text)
+
+    def test_rate_limiter_spaces_requests_per_host(self):
+        limiter = scraper._HostRateLimiter(max_qps=1)
+        with patch.object(scraper.time, "sleep") as mock_sleep:
+            limiter.Wait("http://a/1")
+            limiter.Wait("http://b/1")
+            mock_sleep.assert_not_called()
+            limiter.Wait("http://a/2")
+            self.assertEqual(1, mock_sleep.call_count)
+
+    def test_rate_limiter_backs_off_and_recovers(self):
+        limiter = scraper._HostRateLimiter(max_qps=2, target_latency=1)
+        self.assertTrue(limiter.Observe("http://a/1", 0.1, 503))
+        self.assertEqual(1, limiter.Interval("http://a/1"))
+        self.assertTrue(limiter.Observe("http://a/1", 0.1, 429))
+        self.assertTrue(limiter.Observe("http://a/1", 0.1, None))
+        self.assertTrue(limiter.Observe("http://a/1", 2, 200))
+        self.assertEqual(8, limiter.Interval("http://a/1"))
+        # Other hosts are not slowed down.
+        self.assertEqual(0.5, limiter.Interval("http://b/1"))
+        # The rate grows back linearly, up to max_qps.
+        self.assertFalse(limiter.Observe("http://a/1", 0.1, 404))
+        self.assertEqual(1 / (1 / 8 + 0.5), limiter.Interval("http://a/1"))
+        for _ in range(3):
+            limiter.Observe("http://a/1", 0.1, 200)
+        self.assertEqual(0.5, limiter.Interval("http://a/1"))
+
+    def test_rate_limiter_min_interval_and_retry_after(self):
+        limiter = scraper._HostRateLimiter(max_qps=None)
+        limiter.SetMinInterval("http://a/", 5)
+        self.assertEqual(5, limiter.Interval("http://a/1"))
+        self.assertEqual(0, limiter.Interval("http://b/1"))
+        limiter.Observe("http://b/1", 0.1, 503, retry_after=30)
+        with patch.object(scraper.time, "sleep") as mock_sleep:
+            limiter.Wait("http://b/1")
+        self.assertAlmostEqual(30, mock_sleep.call_args[0][0], places=0)
+
+    def test_robots_crawl_delay_and_ttl(self):
+        self._scraper = scraper.Scraper(
+            self._mock_client,
+            True, # stop_when_present
+            'Morzina',
+            False, # dry_run
+            False, # overwrite
+            self._mock_robot,
+            self._mock_fetcher,
+            max_qps=2,
+            robots_ttl=60)
+        self._mock_robot.crawl_delay.return_value = None
+        self._mock_robot.request_rate.return_value = (
+            robotparser.RequestRate(1, 3))
+        with patch.object(
+                self._scraper, "_CollectListingPages", return_value=iter([])):
+            self._scraper.Run("http:///root/?foo=bar")
+        self._mock_robot.set_url.assert_called_once_with(
+            "http://www.college-de-france.fr/robots.txt")
+        self.assertEqual(
+            3, self._scraper._rate_limiter.Interval(
+                "http://www.college-de-france.fr/page"))
+        self._scraper._CanFetch("http://www.college-de-france.fr/page")
+        self.assertEqual(1, self._mock_robot.read.call_count)
+        # Rules are read again once stale.
+        self._scraper._robots_read_at -= 61
+        self._scraper._CanFetch("http://www.college-de-france.fr/page")
+        self.assertEqual(2, self._mock_robot.read.call_count)
+
+    def test_robots_delay_is_shared_by_shards(self):
+        self._scraper = scraper.Scraper(
+            self._mock_client,
+            True, # stop_when_present
+            'Morzina',
+            False, # dry_run
+            False, # overwrite
+            self._mock_robot,
+            self._mock_fetcher,
+            shard=(1, 4))
+        self._mock_robot.crawl_delay.return_value = 2
+        self._scraper._ReadRobots()
+        self.assertEqual(
+            8, self._scraper._rate_limiter.Interval(
+                "http://www.college-de-france.fr/page"))
+
+
+    _SITE = "http://www.college-de-france.fr"
+    _ROOT = _SITE + "/search.jsp?type=audio"
+
+    def _AsyncSitePages(self):
+        site, root = self._SITE, self._ROOT
+        pages = {
+            site + "/robots.txt": "User-agent: *\nDisallow: /site/private",
+            root + "&index=0": '<a href="/site/10"></a><a href="/site/11"></a>'
+                               '<a href="/site/private"></a>',
+            root + "&index=3": '<a href="/site/12"></a>',
+            root + "&index=6": "no more results",
+        }
+        for hour in (10, 11, 12):
+            pages[site + "/site/%d" % hour] = LECTURE_PAGE.replace(
+                '<span class="from">17:00', '<span class="from">%d:00' % hour)
+        return pages
+
+    def test_async_run(self):
+        site, root = self._SITE, self._ROOT
+        page_fetcher = _FakeAsyncFetcher(self._AsyncSitePages())
+        self._scraper = scraper.AsyncScraper(
+            self._mock_client,
+            True, # stop_when_present
+            'Morzina',
+            False, # dry_run
+            False, # overwrite
+            robotparser.RobotFileParser(),
+            page_fetcher,
+            concurrency=2,
+            listing_concurrency=2)
+        self._mock_client.get_multi.return_value = []
+        self._scraper.Run(root)
+        self.assertEqual(
+            ["10:00", "11:00", "12:00"],
+            [e.key.name.split("|")[-1] for e in self._SavedEntities("Entry")])
+        self.assertEqual(
+            {"OK": 3, "has_video": 3, "disallowed": 1},
+            dict(self._scraper._StatusSnapshot()))
+        self.assertNotIn(site + "/site/private", page_fetcher.fetched)
+        # Plus a probe after the last listing page.
+        self.assertIn(root + "&index=6", page_fetcher.fetched)
+        self.assertTrue(page_fetcher.closed)
+
+    def test_async_listing_stops_when_pages_repeat_past_the_end(self):
+        pages = self._AsyncSitePages()
+        pages[self._ROOT + "&index=6"] = pages[self._ROOT + "&index=3"]
+        pages[self._ROOT + "&index=9"] = pages[self._ROOT + "&index=3"]
+        page_fetcher = _FakeAsyncFetcher(pages)
+        self._scraper = scraper.AsyncScraper(
+            self._mock_client,
+            True, # stop_when_present
+            'Morzina',
+            False, # dry_run
+            False, # overwrite
+            robotparser.RobotFileParser(),
+            page_fetcher)
+        self._mock_client.get_multi.return_value = []
+        self._scraper.Run(self._ROOT)
+        self.assertEqual(3, self._scraper._StatusSnapshot()["OK"])
+        self.assertNotIn(self._ROOT + "&index=9", page_fetcher.fetched)
+
+    def test_async_early_exit_cancels_pages_without_errors(self):
+        pages = self._AsyncSitePages()
+        page_fetcher = _FakeAsyncFetcher(pages)
+        fetch = page_fetcher.Fetch
+
+        async def Fetch(url, headers=None):
+            if url == self._SITE + "/site/12":
+                # Still in flight when the crawl stops.
+                page_fetcher.fetched.append(url)
+                await asyncio.Future()
+            return await fetch(url, headers)
+
+        page_fetcher.Fetch = Fetch
+        crawl_frontier = create_autospec(frontier.Frontier)
+        self._scraper = scraper.AsyncScraper(
+            self._mock_client,
+            True, # stop_when_present
+            'Morzina',
+            False, # dry_run
+            False, # overwrite
+            robotparser.RobotFileParser(),
+            page_fetcher,
+            concurrency=4,
+            crawl_frontier=crawl_frontier)
+        self._SetSaved(Converted=False, Title="A lesson")
+        self._scraper.Run(self._ROOT)
+        self.assertIn(self._SITE + "/site/12", page_fetcher.fetched)
+        self.assertNotIn("error", self._scraper._StatusSnapshot())
+        self.assertNotIn(
+            "error", [c[0][1] for c in crawl_frontier.Record.call_args_list])
+
+    def test_async_resume_fetches_retried_pages_once(self):
+        crawl_frontier = create_autospec(frontier.Frontier)
+        crawl_frontier.IsFinished.return_value = False
+        crawl_frontier.PendingPages.return_value = [self._SITE + "/site/12"]
+        crawl_frontier.LastListingOffset.return_value = 0
+        crawl_frontier.DonePages.return_value = set()
+        page_fetcher = _FakeAsyncFetcher(self._AsyncSitePages())
+        self._scraper = scraper.AsyncScraper(
+            self._mock_client,
+            True, # stop_when_present
+            'Morzina',
+            False, # dry_run
+            False, # overwrite
+            robotparser.RobotFileParser(),
+            page_fetcher,
+            concurrency=2,
+            crawl_frontier=crawl_frontier)
+        self._mock_client.get_multi.return_value = []
+        self._scraper.Run(self._ROOT, resume=True)
+        # Listed after the first listing page, it is still not fetched again.
+        self.assertEqual(
+            1, page_fetcher.fetched.count(self._SITE + "/site/12"))
+        self.assertEqual(
+            {"OK": 3, "has_video": 3, "disallowed": 1},
+            dict(self._scraper._StatusSnapshot()))
+
 
 if __name__ == '__main__':
     logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.DEBUG)
-    locale.setlocale(locale.LC_ALL, 'fr_FR.UTF-8')
     unittest.main()
@@ -0,0 +1,321 @@
+"""Storage sinks the scraper saves lectures to.
+
+A sink implements the subset of the datastore.Client API used by the
+scraper, key, get, get_multi and put_multi on datastore.Key and
+datastore.Entity objects, so a datastore.Client is the Datastore sink as is.
+The local sinks store the entities on disk without any cloud round trip:
+
+- sqlite: a SQLite database with an index on the entity keys, properties
+  are JSON documents that can be queried with the JSON1 functions.
+- jsonl: an append-only JSON lines file.
+- parquet: a directory of Parquet files per kind for analytics, needs
+  pyarrow.
+
+The jsonl and parquet sinks keep an index of the saved keys in memory, not
+the entities.
+"""
+import abc
+import collections
+import datetime
+import json
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+
+from google.cloud import datastore
+try:
+    import pyarrow
+    from pyarrow import parquet
+except ImportError:
+    pyarrow = None
+
+SINKS = ("datastore", "sqlite", "jsonl", "parquet")
+
+# Project of the keys of the local sinks.
+_LOCAL_PROJECT = "local"
+
+# Name of the part files of the Parquet sink.
+_PART_RE = re.compile(r"part-(\d+)\.parquet$")
+
+
+def Open(name, path=None, project_id=None):
+    """Returns a new sink.
+
+    Args:
+        name: one of SINKS.
+        path: where local sinks store entities.
+        project_id: Google Cloud project of the Datastore sink.
+    """
+    if name == "datastore":
+        return datastore.Client(project_id)
+    if not path:
+        raise ValueError("The %s sink needs a path" % name)
+    sinks = {"sqlite": SqliteSink, "jsonl": JsonlSink, "parquet": ParquetSink}
+    return sinks[name](path)
+
+
+def _JsonValue(value):
+    """Datetimes are stored as ISO 8601 strings and bytes as hex strings."""
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return value.hex()
+    return value
+
+
+def _Entity(key, properties):
+    entity = datastore.Entity(key)
+    entity.update(properties)
+    return entity
+
+
+class _LocalSink(abc.ABC):
+    """Base of the sinks storing entities on disk."""
+
+    def key(self, kind, name):
+        return datastore.Key(kind, name, project=_LOCAL_PROJECT)
+
+    def get(self, key):
+        found = self.get_multi([key])
+        return found[0] if found else None
+
+    @abc.abstractmethod
+    def get_multi(self, keys):
+        """Returns the entities found for the given keys, in no order."""
+
+    def put(self, entity):
+        self.put_multi([entity])
+
+    @abc.abstractmethod
+    def put_multi(self, entities):
+        """Saves the entities, replacing the ones with the same keys."""
+
+    def close(self):
+        """Makes all the entities durable and releases the sink."""
+
+
+class _IndexedSink(_LocalSink):
+    """Local sink that only keeps in memory where each entity is stored."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Location of the last saved version of the entities by (kind, name).
+        self._index = {}
+
+    def get_multi(self, keys):
+        with self._lock:
+            found = [
+                (key, self._index[key.kind, key.name])
+                for key in keys if (key.kind, key.name) in self._index]
+            properties = self._Read([location for _, location in found])
+        return [
+            _Entity(key, entity_properties)
+            for (key, _), entity_properties in zip(found, properties)]
+
+    @abc.abstractmethod
+    def _Read(self, locations):
+        """Returns the properties of the entities stored at the locations."""
+
+
+class SqliteSink(_LocalSink):
+    """Stores entities in a SQLite database, one JSON document per entity.
+
+    Properties can be queried with json_extract(properties, '$.Lecturer').
+    Datetimes are stored as ISO 8601 strings and bytes as hex strings, they
+    are read back as such. Safe to use from multiple threads.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path: path of the SQLite database, created if needed.
+        """
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS entities (
+                    kind TEXT,
+                    name TEXT,
+                    properties TEXT,
+                    PRIMARY KEY (kind, name))""")
+            self._db.commit()
+
+    def get_multi(self, keys):
+        keys_by_kind = collections.defaultdict(dict)
+        for key in keys:
+            keys_by_kind[key.kind][key.name] = key
+        found = []
+        with self._lock:
+            for kind, keys_by_name in keys_by_kind.items():
+                rows = self._db.execute(
+                    "SELECT name, properties FROM entities "
+                    "WHERE kind = ? AND name IN (%s)" %
+                    ",".join("?" * len(keys_by_name)),
+                    [kind] + list(keys_by_name)).fetchall()
+                found.extend(
+                    _Entity(keys_by_name[name], json.loads(properties))
+                    for name, properties in rows)
+        return found
+
+    def put_multi(self, entities):
+        rows = [
+            (entity.key.kind, entity.key.name, json.dumps(
+                {k: _JsonValue(v) for k, v in entity.items()},
+                ensure_ascii=False))
+            for entity in entities]
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO entities VALUES (?, ?, ?)", rows)
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class JsonlSink(_IndexedSink):
+    """Appends entities to a JSON lines file.
+
+    Each line is an object with the properties of an entity plus its
+    "__kind__" and "__key__" name. A saved again entity is appended again,
+    its last line wins. The file is scanned when opened to index the offset
+    of the last line of each entity, an unterminated last line left by a
+    killed crawl is dropped. Datetimes are stored as ISO 8601 strings and
+    bytes as hex strings.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path: path of the JSON lines file, created if needed.
+        """
+        super().__init__()
+        self._path = path
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                offset = 0
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    properties = json.loads(line.decode("utf-8"))
+                    self._index[
+                        properties["__kind__"], properties["__key__"]] = offset
+                    offset += len(line)
+            if offset < os.path.getsize(path):
+                logging.warning(
+                    "Dropping the unterminated last line of %s", path)
+                os.truncate(path, offset)
+        self._file = open(path, "ab")
+
+    def put_multi(self, entities):
+        lines = []
+        with self._lock:
+            offset = self._file.tell()
+            for entity in entities:
+                properties = {k: _JsonValue(v) for k, v in entity.items()}
+                properties.update(
+                    __kind__=entity.key.kind, __key__=entity.key.name)
+                line = (json.dumps(properties, ensure_ascii=False) +
+                        "\n").encode("utf-8")
+                self._index[entity.key.kind, entity.key.name] = offset
+                offset += len(line)
+                lines.append(line)
+            self._file.write(b"".join(lines))
+            self._file.flush()
+
+    def _Read(self, offsets):
+        found = []
+        with open(self._path, "rb") as f:
+            for offset in offsets:
+                f.seek(offset)
+                properties = json.loads(f.readline().decode("utf-8"))
+                del properties["__kind__"], properties["__key__"]
+                found.append(properties)
+        return found
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class ParquetSink(_IndexedSink):
+    """Stores entities in a directory of Parquet files.
+
+    Each put_multi call writes one part file per kind, named
+    "<kind>/part-<number>.parquet", so that a killed crawl keeps what it
+    saved. Each file has a "__key__" column with the name of the entities and
+    one column per property. A saved again entity is written again in a new
+    part, the part with the highest number wins.
+    """
+
+    def __init__(self, directory):
+        """
+        Args:
+            directory: the directory of the Parquet files, created if needed.
+        """
+        if pyarrow is None:
+            raise ValueError("pyarrow is not installed")
+        super().__init__()
+        self._dir = directory
+        self._next_part = 0
+        os.makedirs(directory, exist_ok=True)
+        parts = []
+        for kind in os.listdir(directory):
+            kind_dir = os.path.join(directory, kind)
+            if not os.path.isdir(kind_dir):
+                continue
+            for name in os.listdir(kind_dir):
+                match = _PART_RE.match(name)
+                if match:
+                    parts.append((int(match.group(1)), kind))
+        for number, kind in sorted(parts):
+            path = self._PartPath(kind, number)
+            keys = parquet.read_table(path, columns=["__key__"]).column(0)
+            for row, key in enumerate(keys.to_pylist()):
+                self._index[kind, key] = (path, row)
+            self._next_part = number + 1
+
+    def _PartPath(self, kind, number):
+        return os.path.join(self._dir, kind, "part-%05d.parquet" % number)
+
+    def put_multi(self, entities):
+        rows_by_kind = collections.OrderedDict()
+        for entity in entities:
+            rows_by_kind.setdefault(entity.key.kind, []).append(
+                dict(entity, __key__=entity.key.name))
+        with self._lock:
+            for kind, rows in rows_by_kind.items():
+                columns = ["__key__"] + sorted(
+                    {name for row in rows for name in row} - {"__key__"})
+                table = pyarrow.table(collections.OrderedDict(
+                    (column, [row.get(column) for row in rows])
+                    for column in columns))
+                path = self._PartPath(kind, self._next_part)
+                self._next_part += 1
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(
+                    dir=os.path.dirname(path), prefix=".")
+                os.close(fd)
+                parquet.write_table(table, tmp_path)
+                os.replace(tmp_path, path)
+                for row_number, row in enumerate(rows):
+                    self._index[kind, row["__key__"]] = (path, row_number)
+
+    def _Read(self, locations):
+        rows_by_path = collections.defaultdict(set)
+        for path, row in locations:
+            rows_by_path[path].add(row)
+        found = {}
+        for path, rows in rows_by_path.items():
+            rows = sorted(rows)
+            table = parquet.read_table(path).take(rows)
+            for row, properties in zip(rows, table.to_pylist()):
+                found[path, row] = {
+                    k: v for k, v in properties.items()
+                    if v is not None and k != "__key__"}
+        return [found[location] for location in locations]
@@ -0,0 +1,120 @@
+import datetime
+import logging
+import os
+import tempfile
+import unittest
+
+from google.cloud import datastore
+
+import sinks
+
+
+class _SinkTest(object):
+    """Tests shared by all the local sinks, _Open returns a new sink."""
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._sink = self._Open()
+
+    def tearDown(self):
+        self._sink.close()
+        self._dir.cleanup()
+
+    def _Entry(self, sink, name, **properties):
+        entity = datastore.Entity(sink.key("Entry", name))
+        entity.update(properties)
+        return entity
+
+    def test_get_multi_finds_saved_entities(self):
+        self._sink.put_multi([
+            self._Entry(self._sink, "a", Title="Leçon", Converted=False),
+            self._Entry(self._sink, "b", Title="Cours"),
+        ])
+        self._sink.put(self._Entry(self._sink, "b", Title="Cours 2"))
+        found = self._sink.get_multi([
+            self._sink.key("Entry", "a"), self._sink.key("Entry", "c"),
+            self._sink.key("Page", "a"), self._sink.key("Entry", "b")])
+        self.assertEqual(
+            {"a": {"Title": "Leçon", "Converted": False},
+             "b": {"Title": "Cours 2"}},
+            {entity.key.name: dict(entity) for entity in found})
+        self.assertIsNone(self._sink.get(self._sink.key("Entry", "c")))
+
+    def test_entities_survive_reopening(self):
+        self._sink.put(self._Entry(
+            self._sink, "a", Date=datetime.datetime(2017, 6, 29)))
+        self._sink.close()
+        self._sink = self._Open()
+        self.assertIsNotNone(self._sink.get(self._sink.key("Entry", "a")))
+
+    def test_entities_saved_before_close(self):
+        self._sink.put(self._Entry(self._sink, "a", Title="Leçon"))
+        # Like a crawl killed before closing its sink.
+        other = self._Open()
+        self.addCleanup(other.close)
+        self.assertEqual(
+            "Leçon", other.get(other.key("Entry", "a"))["Title"])
+
+
+class TestSqliteSink(_SinkTest, unittest.TestCase):
+    def _Open(self):
+        return sinks.Open("sqlite", os.path.join(self._dir.name, "sink.db"))
+
+
+class TestJsonlSink(_SinkTest, unittest.TestCase):
+    def _Open(self):
+        return sinks.Open("jsonl", os.path.join(self._dir.name, "sink.jsonl"))
+
+
+    def test_unterminated_last_line_is_dropped(self):
+        self._sink.put(self._Entry(self._sink, "a", Title="Leçon"))
+        self._sink.close()
+        # Like a crawl killed while writing an entity.
+        with open(os.path.join(self._dir.name, "sink.jsonl"), "ab") as f:
+            f.write(b'{"Title": "Cou')
+        self._sink = self._Open()
+        self._sink.put(self._Entry(self._sink, "b", Title="Cours"))
+        self._sink.close()
+        self._sink = self._Open()
+        found = self._sink.get_multi([
+            self._sink.key("Entry", "a"), self._sink.key("Entry", "b")])
+        self.assertEqual(
+            ["Leçon", "Cours"], [entity["Title"] for entity in found])
+
+
+@unittest.skipIf(sinks.pyarrow is None, "pyarrow is not installed")
+class TestParquetSink(_SinkTest, unittest.TestCase):
+    def _Open(self):
+        return sinks.Open("parquet", os.path.join(self._dir.name, "sink"))
+
+    def test_one_part_per_kind_and_write_with_native_types(self):
+        self._sink.put_multi([
+            self._Entry(
+                self._sink, "a", Date=datetime.datetime(2017, 6, 29),
+                Hash=b"\x01"),
+            datastore.Entity(self._sink.key("Page", "http:///page/a")),
+        ])
+        # Written right away, before the sink is closed.
+        table = sinks.parquet.read_table(os.path.join(
+            self._dir.name, "sink", "Entry", "part-00000.parquet"))
+        self.assertEqual(
+            [{"__key__": "a", "Date": datetime.datetime(2017, 6, 29),
+              "Hash": b"\x01"}],
+            table.to_pylist())
+        self.assertTrue(os.path.exists(os.path.join(
+            self._dir.name, "sink", "Page", "part-00001.parquet")))
+        self._sink.put(self._Entry(self._sink, "a", Title="Leçon"))
+        self._sink.close()
+        # The last part wins and new parts do not overwrite the previous ones.
+        self._sink = self._Open()
+        self.assertEqual(
+            {"Title": "Leçon"},
+            dict(self._sink.get(self._sink.key("Entry", "a"))))
+        self._sink.put(self._Entry(self._sink, "b"))
+        self.assertEqual(
+            ["part-00000.parquet", "part-00002.parquet", "part-00003.parquet"],
+            sorted(os.listdir(os.path.join(self._dir.name, "sink", "Entry"))))
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=logging.DEBUG)
+    unittest.main()